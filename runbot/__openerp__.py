@@ -6,9 +6,6 @@
     'description': "Runbot",
     'author': 'Odoo SA',
     'depends': ['website', 'base_setup'],
-    'external_dependencies': {
-        'python': ['matplotlib'],
-    },
     'data': [
         'runbot.xml',
         'res_config_view.xml',
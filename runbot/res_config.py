@@ -30,6 +30,20 @@ class runbot_config_settings(osv.osv_memory):
         'default_timeout': fields.integer('Default Timeout (in seconds)'),
         'default_starting_port': fields.integer('Starting Port for Running Builds'),
         'default_domain': fields.char('Runbot Domain'),
+        'default_fetch_workers': fields.integer('Number of Repositories Fetched Concurrently'),
+        'default_log_max_age': fields.integer('Days to Keep the Logs of Done Builds (0 to keep them)'),
+        'default_timing_baseline': fields.integer('Number of Builds in the Timings Baseline'),
+        'default_timing_regression': fields.float('Timing Regression Threshold (%)'),
+        'default_feed_max_wait': fields.integer('Maximum Wait of the Build Feed (in seconds, 0 to disable waiting)'),
+        'default_cgroup': fields.char('Cgroup (v2) of the Jobs', help="Each job runs in its own cgroup under this one, "
+                                                                       "leave empty to run jobs without cgroups"),
+        'default_cgroup_cpu_weight': fields.integer('CPU Weight of the Jobs'),
+        'default_cgroup_memory_max': fields.integer('Maximum Memory of the Jobs (MiB, 0 for no limit)'),
+        'default_cgroup_io_weight': fields.integer('IO Weight of the Jobs'),
+        'default_sched_sticky_boost': fields.float('Priority Boost of Sticky Branches'),
+        'default_sched_aging': fields.float('Priority Gained per Minute of Waiting'),
+        'default_sched_repo_share': fields.float('Priority Lost per Build of the Same Repository'),
+        'default_sched_author_share': fields.float('Priority Lost per Build of the Same Author'),
     }
 
     def get_default_parameters(self, cr, uid, fields, context=None):
@@ -39,12 +53,38 @@ class runbot_config_settings(osv.osv_memory):
         timeout = icp.get_param(cr, uid, 'runbot.timeout', default=1800)
         starting_port = icp.get_param(cr, uid, 'runbot.starting_port', default=2000)
         runbot_domain = icp.get_param(cr, uid, 'runbot.domain', default='runbot.odoo.com')
+        fetch_workers = icp.get_param(cr, uid, 'runbot.fetch_workers', default=4)
+        log_max_age = icp.get_param(cr, uid, 'runbot.log_max_age', default=0)
+        timing_baseline = icp.get_param(cr, uid, 'runbot.timing_baseline', default=10)
+        timing_regression = icp.get_param(cr, uid, 'runbot.timing_regression', default=20)
+        feed_max_wait = icp.get_param(cr, uid, 'runbot.feed_max_wait', default=0)
+        cgroup = icp.get_param(cr, uid, 'runbot.cgroup', default='')
+        cgroup_cpu_weight = icp.get_param(cr, uid, 'runbot.cgroup_cpu_weight', default=100)
+        cgroup_memory_max = icp.get_param(cr, uid, 'runbot.cgroup_memory_max', default=0)
+        cgroup_io_weight = icp.get_param(cr, uid, 'runbot.cgroup_io_weight', default=100)
+        sched_sticky_boost = icp.get_param(cr, uid, 'runbot.sched_sticky_boost', default=1000)
+        sched_aging = icp.get_param(cr, uid, 'runbot.sched_aging', default=0)
+        sched_repo_share = icp.get_param(cr, uid, 'runbot.sched_repo_share', default=0)
+        sched_author_share = icp.get_param(cr, uid, 'runbot.sched_author_share', default=0)
         return {
             'default_workers': int(workers),
             'default_running_max': int(running_max),
             'default_timeout': int(timeout),
             'default_starting_port': int(starting_port),
             'default_domain': runbot_domain,
+            'default_fetch_workers': int(fetch_workers),
+            'default_log_max_age': int(log_max_age),
+            'default_timing_baseline': int(timing_baseline),
+            'default_timing_regression': float(timing_regression),
+            'default_feed_max_wait': int(feed_max_wait),
+            'default_cgroup': cgroup,
+            'default_cgroup_cpu_weight': int(cgroup_cpu_weight),
+            'default_cgroup_memory_max': int(cgroup_memory_max),
+            'default_cgroup_io_weight': int(cgroup_io_weight),
+            'default_sched_sticky_boost': float(sched_sticky_boost),
+            'default_sched_aging': float(sched_aging),
+            'default_sched_repo_share': float(sched_repo_share),
+            'default_sched_author_share': float(sched_author_share),
         }
 
     def set_default_parameters(self, cr, uid, ids, context=None):
@@ -55,6 +95,19 @@ class runbot_config_settings(osv.osv_memory):
         icp.set_param(cr, uid, 'runbot.timeout', config.default_timeout)
         icp.set_param(cr, uid, 'runbot.starting_port', config.default_starting_port)
         icp.set_param(cr, uid, 'runbot.domain', config.default_domain)
+        icp.set_param(cr, uid, 'runbot.fetch_workers', config.default_fetch_workers)
+        icp.set_param(cr, uid, 'runbot.log_max_age', config.default_log_max_age)
+        icp.set_param(cr, uid, 'runbot.timing_baseline', config.default_timing_baseline)
+        icp.set_param(cr, uid, 'runbot.timing_regression', config.default_timing_regression)
+        icp.set_param(cr, uid, 'runbot.feed_max_wait', config.default_feed_max_wait)
+        icp.set_param(cr, uid, 'runbot.cgroup', config.default_cgroup or '')
+        icp.set_param(cr, uid, 'runbot.cgroup_cpu_weight', config.default_cgroup_cpu_weight)
+        icp.set_param(cr, uid, 'runbot.cgroup_memory_max', config.default_cgroup_memory_max)
+        icp.set_param(cr, uid, 'runbot.cgroup_io_weight', config.default_cgroup_io_weight)
+        icp.set_param(cr, uid, 'runbot.sched_sticky_boost', config.default_sched_sticky_boost)
+        icp.set_param(cr, uid, 'runbot.sched_aging', config.default_sched_aging)
+        icp.set_param(cr, uid, 'runbot.sched_repo_share', config.default_sched_repo_share)
+        icp.set_param(cr, uid, 'runbot.sched_author_share', config.default_sched_author_share)
 
 
 # vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
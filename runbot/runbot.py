@@ -1,14 +1,17 @@
 # -*- encoding: utf-8 -*-
 
+import ast
 import contextlib
 import datetime
 import fcntl
 import glob
 import hashlib
+import hmac
 import itertools
 import logging
 import operator
 import os
+import pipes
 import psycopg2
 import re
 import resource
@@ -18,14 +21,15 @@ import simplejson
 import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import dateutil.parser
 from dateutil.relativedelta import relativedelta
 import requests
-from matplotlib.font_manager import FontProperties
-from matplotlib.textpath import TextToPath
 import werkzeug
 
 import openerp
@@ -37,6 +41,8 @@ from openerp.tools import config, appdirs
 from openerp.addons.website.models.website import slug
 from openerp.addons.website_sale.controllers.main import QueryURL
 
+from font import text_width
+
 _logger = logging.getLogger(__name__)
 
 #----------------------------------------------------------
@@ -46,7 +52,31 @@ _logger = logging.getLogger(__name__)
 _re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$'
 _re_warning = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING '
 _re_job = re.compile('_job_\d')
+_re_test_time = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ \w+ \S+ (?:openerp|odoo)\.addons\.(\w+)\.tests\.(\w+): Ran (\d+) tests? in ([\d.]+)s')
+_re_module_time = re.compile(r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ \w+ \S+ (?:openerp|odoo)\.modules\.loading: Module (\w+) loaded in ([\d.]+)s')
 _re_coverage = re.compile(r'\bcoverage\b')
+_re_github_id = re.compile(r'/(?:[0-9a-f]{40}|\d+)(?=/|$)')
+_re_sha = re.compile(r'^[0-9a-f]{40}$')
+_re_branch_ref = re.compile(r'^refs/heads/(?!.*\.\.)(?!.*//)[\w-][\w./-]*(?<![./])(?<!\.lock)$')
+
+# displayed values of a build b of repo r, shared by the function fields and
+# the build feed; the server logs are looked up through runbot_logging_problem_index
+_sql_guess_result = """
+    CASE WHEN b.state != 'testing' THEN b.result
+         WHEN b.log_errors > 0 OR EXISTS (SELECT 1 FROM ir_logging l
+                                           WHERE l.build_id = b.id
+                                             AND l.level IN ('ERROR', 'CRITICAL')) THEN 'ko'
+         WHEN b.log_warnings > 0 OR EXISTS (SELECT 1 FROM ir_logging l
+                                             WHERE l.build_id = b.id
+                                               AND l.level = 'WARNING') THEN 'warn'
+         ELSE 'ok'
+     END"""
+_sql_domain = """
+    CASE WHEN r.nginx THEN concat(b.dest, '.', b.host)
+         ELSE concat(%(domain)s, ':', b.port)
+     END"""
+_sql_job_time = "coalesce(extract(epoch FROM coalesce(b.job_end, clock_timestamp() at time zone 'UTC') - b.job_start), 0)::int"
+_sql_job_age = "coalesce(extract(epoch FROM (clock_timestamp() at time zone 'UTC') - b.job_start), 0)::int"
 
 # increase cron frequency from 0.016 Hz to 0.1 Hz to reduce starvation and improve throughput with many workers
 # TODO: find a nicer way than monkey patch to accomplish this
@@ -80,6 +110,41 @@ def grep(filename, string):
         return open(filename).read().find(string) != -1
     return False
 
+def scan_log(filename, offset=0, markers=(), final=False):
+    """Scan the lines appended to filename since offset
+
+    Only complete lines are consumed unless final is set, so a line being
+    written is scanned on the next call. Return the new offset, the number
+    of error and warning lines, the markers found in the new lines and the
+    timings they report as (module, test, tests, duration) tuples, test
+    being False for the install of the module.
+    """
+    found = set()
+    timings = []
+    errors = warnings = 0
+    with open(filename, 'r') as f:
+        f.seek(offset)
+        data = f.read()
+    if not final:
+        data = data[:data.rfind('\n') + 1]
+    for line in data.splitlines():
+        if re.search(_re_error, line):
+            errors += 1
+        elif re.search(_re_warning, line):
+            warnings += 1
+        elif ' tests in ' in line or ' test in ' in line:
+            m = _re_test_time.match(line)
+            if m:
+                timings.append((m.group(1), m.group(2), int(m.group(3)), float(m.group(4))))
+        elif ' loaded in ' in line:
+            m = _re_module_time.match(line)
+            if m:
+                timings.append((m.group(1), False, 0, float(m.group(2))))
+    for marker in markers:
+        if marker in data:
+            found.add(marker)
+    return offset + len(data), errors, warnings, found, timings
+
 def rfind(filename, pattern):
     """Determine in something in filename matches the pattern"""
     if os.path.isfile(filename):
@@ -153,9 +218,220 @@ def decode_utf(field):
 def uniq_list(l):
     return OrderedDict.fromkeys(l).keys()
 
+def build_dest(build_id, ref_name, sha):
+    """Return the directory/database prefix of a build"""
+    nickname = dashes(ref_name.split('/')[2])[:32]
+    return ("%05d-%s-%s" % (build_id, nickname, sha[:6])).lower()
+
+# job processes by pid, kept referenced until _reap so that subprocess does
+# not wait for them itself and their resource usage is not lost
+_spawned = {}
+
+_reflink_support = {}
+
+# rendered badges by (theme, branch, state), see RunbotController.badge
+_badge_cache = OrderedDict()
+_badge_cache_lock = threading.Lock()
+_badge_cache_size = 1000
+
+# build counters by database, see runbot_build._stats
+_stats_cache = {}
+_stats_ttl = 5
+
+def link_tree(src, dest):
+    """Copy the content of directory src into dest, without copying file data
+    if the filesystem supports reflinks. Files are never hardlinked, since
+    writing into dest would then change src as well."""
+    mkdirs([dest])
+    device = os.stat(src).st_dev
+    if _reflink_support.get(device, True):
+        if not run(['cp', '-a', '--reflink=always', '--remove-destination', src + '/.', dest]):
+            return
+        _reflink_support[device] = False
+    if run(['cp', '-a', '--remove-destination', src + '/.', dest]):
+        raise OSError('Failed to copy %s into %s' % (src, dest))
+
 def fqdn():
     return socket.getfqdn()
 
+def host_resources(path):
+    """Return the number of CPUs, the 1 minute load average, the available
+    memory (KiB) and the space available under path (KiB) on this host"""
+    memory = {}
+    with open('/proc/meminfo') as f:
+        for line in f:
+            key, value = line.split(':', 1)
+            memory[key] = int(value.split()[0])
+    available = memory.get('MemAvailable')
+    if available is None:
+        available = memory.get('MemFree', 0) + memory.get('Buffers', 0) + memory.get('Cached', 0)
+    st = os.statvfs(path)
+    return os.sysconf('SC_NPROCESSORS_ONLN'), os.getloadavg()[0], available, st.f_bavail * st.f_frsize // 1024
+
+def cgroup_write(path, name, value):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(str(value))
+
+def cgroup_create(path, cpu_weight=None, memory_max=None, io_weight=None):
+    """Create the cgroup v2 directory path and set its limits, memory_max
+    in MiB. The parent must delegate the cpu, memory and io controllers."""
+    parent = os.path.dirname(path)
+    try:
+        cgroup_write(parent, 'cgroup.subtree_control', '+cpu +memory +io')
+    except (IOError, OSError):
+        pass
+    if not os.path.isdir(path):
+        os.mkdir(path)
+    limits = [
+        ('cpu.weight', cpu_weight),
+        ('memory.max', memory_max and memory_max * 1024 * 1024),
+        ('io.weight', io_weight and 'default %s' % io_weight),
+    ]
+    for name, value in limits:
+        if value:
+            try:
+                cgroup_write(path, name, value)
+            except (IOError, OSError):
+                _logger.warning('cgroup %s: could not set %s', path, name)
+
+def cgroup_kill(path):
+    """Kill every process of the cgroup path"""
+    if not os.path.isdir(path):
+        return
+    try:
+        # linux >= 5.14
+        cgroup_write(path, 'cgroup.kill', 1)
+        return
+    except (IOError, OSError):
+        pass
+    with open(os.path.join(path, 'cgroup.procs')) as f:
+        for pid in f.read().split():
+            try:
+                os.kill(int(pid), signal.SIGKILL)
+            except OSError:
+                pass
+
+def cgroup_stats(path):
+    """Return the cumulated user and system CPU time (s), peak memory (KiB,
+    None before linux 5.19), and 512 bytes blocks read and written by the
+    cgroup path"""
+    stats = {}
+    with open(os.path.join(path, 'cpu.stat')) as f:
+        for line in f:
+            key, value = line.split()
+            stats[key] = int(value)
+    peak = None
+    if os.path.isfile(os.path.join(path, 'memory.peak')):
+        with open(os.path.join(path, 'memory.peak')) as f:
+            peak = int(f.read()) // 1024
+    rbytes = wbytes = 0
+    with open(os.path.join(path, 'io.stat')) as f:
+        for line in f:
+            for field in line.split()[1:]:
+                key, value = field.split('=')
+                if key == 'rbytes':
+                    rbytes += int(value)
+                elif key == 'wbytes':
+                    wbytes += int(value)
+    return (stats.get('user_usec', 0) / 1e6, stats.get('system_usec', 0) / 1e6,
+            peak, rbytes // 512, wbytes // 512)
+
+def cgroup_remove(path):
+    """Kill the processes left in the cgroup path and remove it"""
+    cgroup_kill(path)
+    try:
+        os.rmdir(path)
+    except OSError:
+        # processes still exiting, removed by runbot_build._local_cleanup
+        pass
+
+def update_file(path, content):
+    """Write content to path unless it already contains it, return whether
+    the file changed"""
+    if os.path.isfile(path):
+        with open(path) as f:
+            if hashlib.md5(f.read()).digest() == hashlib.md5(content).digest():
+                return False
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
+
+def port_free(port):
+    """Check that nothing listens on port on this host"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # connections of a previous server left in TIME_WAIT do not make it busy
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sock.bind(('', port))
+        return True
+    except (socket.error, OverflowError):
+        return False
+    finally:
+        sock.close()
+
+class GithubClient(object):
+    """Github API client shared by all the repos using the same token.
+
+    Keeps connections alive, sends GET requests conditionally on the ETag
+    of the previous response (not modified responses are not counted by
+    github), stops sending requests when the rate limit is exhausted and
+    counts the requests sent to each endpoint.
+    """
+    max_cached = 1000
+
+    def __init__(self, token):
+        self.session = requests.Session()
+        self.session.auth = (token, 'x-oauth-basic')
+        self.session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=8))
+        self.lock = threading.Lock()
+        self.responses = OrderedDict()  # url: (etag, json)
+        self.counts = Counter()
+        self.remaining = None
+        self.reset = 0
+
+    def request(self, url, payload=None):
+        if self.remaining == 0 and time.time() < self.reset:
+            raise Exception('github rate limit exhausted until %s' % time.ctime(self.reset))
+        with self.lock:
+            self.counts[_re_github_id.sub('/:id', url)] += 1
+            if sum(self.counts.values()) % 100 == 0:
+                _logger.info('github: %s requests remaining, sent %r', self.remaining, dict(self.counts))
+            cached = None if payload else self.responses.pop(url, None)
+        if payload:
+            response = self.session.post(url, data=simplejson.dumps(payload))
+        else:
+            headers = {'If-None-Match': cached[0]} if cached else {}
+            response = self.session.get(url, headers=headers)
+
+        if 'X-RateLimit-Remaining' in response.headers:
+            self.remaining = int(response.headers['X-RateLimit-Remaining'])
+            self.reset = int(response.headers.get('X-RateLimit-Reset', 0))
+            if self.remaining == 0:
+                _logger.warning('github rate limit exhausted until %s', time.ctime(self.reset))
+
+        if response.status_code == 304 and cached:
+            result = cached[1]
+        else:
+            response.raise_for_status()
+            result = response.json()
+            cached = (response.headers['ETag'], result) if 'ETag' in response.headers else None
+        if cached and not payload:
+            with self.lock:
+                self.responses[url] = cached
+                while len(self.responses) > self.max_cached:
+                    self.responses.popitem(last=False)
+        return result
+
+_github_clients = {}
+_github_clients_lock = threading.Lock()
+
+def github_client(token):
+    with _github_clients_lock:
+        if token not in _github_clients:
+            _github_clients[token] = GithubClient(token)
+        return _github_clients[token]
+
 @contextlib.contextmanager
 def local_pgadmin_cursor():
     cnx = None
@@ -216,6 +492,8 @@ class runbot_repo(osv.osv):
             string='Extra dependencies',
             help="Community addon repos which need to be present to run tests."),
         'token': fields.char("Github token", groups="runbot.group_runbot_admin"),
+        'hook_secret': fields.char("Webhook secret", groups="runbot.group_runbot_admin",
+                                   help="Secret of the webhook, whose payloads must then be sent as application/json"),
         'group_ids': fields.many2many('res.groups', string='Limited to groups'),
     }
     _defaults = {
@@ -241,12 +519,61 @@ class runbot_repo(osv.osv):
             return subprocess.check_output(cmd)
 
     def _git_export(self, cr, uid, ids, treeish, dest, context=None):
+        cache_dir = os.path.join(self._root(cr, uid), 'tree')
         for repo in self.browse(cr, uid, ids, context=context):
             _logger.debug('checkout %s %s %s', repo.name, treeish, dest)
-            p1 = subprocess.Popen(['git', '--git-dir=%s' % repo.path, 'archive', treeish], stdout=subprocess.PIPE)
+            tree = repo._git(['rev-parse', '%s^{tree}' % treeish]).strip()
+            self._export_tree(repo.path, cache_dir, tree, dest)
+
+    def _export_tree(self, repo_path, cache_dir, tree, dest, depth=3):
+        """Export the git tree in dest.
+
+        Modules (directories with an __init__.py or a manifest) are linked
+        from a cache materialized once per tree sha, other directories are
+        walked so that only the modules that changed have to be extracted.
+        """
+        git = ['git', '--git-dir=%s' % repo_path]
+        entries = []
+        for line in subprocess.check_output(git + ['ls-tree', '-z', tree]).split('\0'):
+            if line:
+                info, name = line.split('\t', 1)
+                mode, kind, sha = info.split()
+                entries.append((kind, sha, name))
+        blobs = [name for kind, sha, name in entries if kind == 'blob']
+        if depth <= 0 or set(blobs) & set(['__init__.py', '__openerp__.py', '__manifest__.py']):
+            link_tree(self._cached_tree(repo_path, cache_dir, tree), dest)
+            return
+        mkdirs([dest])
+        if blobs:
+            p1 = subprocess.Popen(git + ['archive', tree, '--'] + blobs, stdout=subprocess.PIPE)
             p2 = subprocess.Popen(['tar', '-xmC', dest], stdin=p1.stdout, stdout=subprocess.PIPE)
             p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
             p2.communicate()[0]
+        for kind, sha, name in entries:
+            if kind == 'tree':
+                self._export_tree(repo_path, cache_dir, sha, os.path.join(dest, name), depth - 1)
+
+    def _cached_tree(self, repo_path, cache_dir, tree):
+        """Return the directory holding the content of the git tree, extracting it if needed"""
+        path = os.path.join(cache_dir, tree[:2], tree)
+        if os.path.isdir(path):
+            os.utime(path, None)    # keep it from the cleanup
+            return path
+        mkdirs([os.path.dirname(path)])
+        tmp = tempfile.mkdtemp(prefix=tree + '.', dir=os.path.dirname(path))
+        p1 = subprocess.Popen(['git', '--git-dir=%s' % repo_path, 'archive', tree], stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(['tar', '-xmC', tmp], stdin=p1.stdout, stdout=subprocess.PIPE)
+        p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
+        p2.communicate()[0]
+        if p1.wait() or p2.returncode:
+            shutil.rmtree(tmp)
+            raise subprocess.CalledProcessError(p1.returncode or p2.returncode, 'git archive %s' % tree)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # extracted concurrently by another build
+            shutil.rmtree(tmp)
+        return path
 
     def _github(self, cr, uid, ids, url, payload=None, ignore_errors=False, context=None):
         """Return a http request to be sent to github"""
@@ -259,103 +586,301 @@ class runbot_repo(osv.osv):
                     url = url.replace(':owner', match_object.group(2))
                     url = url.replace(':repo', match_object.group(3))
                     url = 'https://api.%s%s' % (match_object.group(1),url)
-                    session = requests.Session()
-                    session.auth = (repo.token,'x-oauth-basic')
-                    session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
-                    if payload:
-                        response = session.post(url, data=simplejson.dumps(payload))
-                    else:
-                        response = session.get(url)
-                    response.raise_for_status()
-                    return response.json()
+                    return github_client(repo.token).request(url, payload)
             except Exception:
                 if ignore_errors:
                     _logger.exception('Ignored github error %s %r', url, payload)
                 else:
                     raise
 
+    def _github_queue_status(self, cr, uid, ids, sha, status, context=None):
+        """Queue the commit status to be sent to github by _cron_github_status,
+        superseding the unsent status of the same commit and context"""
+        for repo_id in ids:
+            cr.execute("""
+                INSERT INTO runbot_github_status (create_uid, create_date, write_uid, write_date,
+                                                  repo_id, sha, context, state, target_url, description,
+                                                  attempts, next_try)
+                     VALUES (%(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC',
+                             %(repo_id)s, %(sha)s, %(context)s, %(state)s, %(target_url)s, %(description)s,
+                             0, now() at time zone 'UTC')
+                ON CONFLICT (repo_id, sha, context) DO UPDATE
+                        SET write_uid = EXCLUDED.write_uid, write_date = EXCLUDED.write_date,
+                            state = EXCLUDED.state, target_url = EXCLUDED.target_url,
+                            description = EXCLUDED.description, attempts = 0, next_try = EXCLUDED.next_try
+            """, dict(status, uid=uid, repo_id=repo_id, sha=sha))
+
+    def _cron_github_status(self, cr, uid, limit=100, context=None):
+        """Send the queued commit statuses, retrying failures with an exponential backoff"""
+        # lease the statuses to send so that other hosts skip them while we wait for github
+        cr.execute("""
+            UPDATE runbot_github_status
+               SET next_try = (now() at time zone 'UTC') + interval '5 minutes'
+             WHERE id IN (SELECT id
+                            FROM runbot_github_status
+                           WHERE next_try <= (now() at time zone 'UTC')
+                        ORDER BY id
+                           LIMIT %s
+                             FOR UPDATE SKIP LOCKED)
+         RETURNING id, repo_id, sha, context, state, target_url, description, attempts
+        """, [limit])
+        statuses = cr.dictfetchall()
+        cr.commit()
+
+        for status in statuses:
+            # a status superseded while being sent stays in the queue
+            where = """id = %(id)s AND state IS NOT DISTINCT FROM %(state)s
+                       AND target_url IS NOT DISTINCT FROM %(target_url)s
+                       AND description IS NOT DISTINCT FROM %(description)s"""
+            repo = self.browse(cr, uid, status['repo_id'], context=context)
+            payload = dict((k, status[k]) for k in ['state', 'target_url', 'description', 'context'])
+            try:
+                repo._github('/repos/:owner/:repo/statuses/%s' % status['sha'], payload)
+            except Exception:
+                _logger.exception('Failed to send github status %s %r', status['sha'], payload)
+                if status['attempts'] < 5:
+                    cr.execute("""
+                        UPDATE runbot_github_status
+                           SET attempts = attempts + 1,
+                               next_try = (now() at time zone 'UTC') + interval '1 minute' * 2 ^ attempts
+                         WHERE """ + where, status)
+                    continue
+            cr.execute("DELETE FROM runbot_github_status WHERE " + where, status)
+
     def _update(self, cr, uid, ids, context=None):
-        for repo in self.browse(cr, uid, ids, context=context):
+        icp = self.pool['ir.config_parameter']
+        fetch_workers = int(icp.get_param(cr, uid, 'runbot.fetch_workers', default=4))
+        repos = self.browse(cr, uid, ids, context=context)
+
+        # refs announced by webhooks, latest sha of each ref only
+        hook_refs = {}
+        cr.execute("DELETE FROM runbot_hook_ref WHERE create_date < (now() at time zone 'UTC') - interval '1 day'")
+        if ids:
+            cr.execute("""
+                SELECT DISTINCT ON (repo_id, name) repo_id, name, sha, id
+                  FROM runbot_hook_ref
+                 WHERE repo_id IN %s
+              ORDER BY repo_id, name, id DESC
+            """, [tuple(ids)])
+            for repo_id, name, sha, hook_id in cr.fetchall():
+                hook_refs.setdefault(repo_id, []).append((name, sha, hook_id))
+
+        # fetch concurrently, the threads never touch the cursor
+        fetch_args = [(repo.name, repo.path, repo.hook_time if repo.mode == 'hook' else False,
+                       hook_refs.get(repo.id) if repo.mode == 'hook' else None)
+                      for repo in repos]
+        fetched = []
+        if fetch_args:
+            pool = ThreadPool(max(1, min(fetch_workers, len(fetch_args))))
+            try:
+                fetched = pool.map(lambda args: self._fetch_git_safe(*args), fetch_args)
+            finally:
+                pool.close()
+                pool.join()
+
+        # reconcile refs sequentially on the cron cursor
+        for repo, fetched_refs in zip(repos, fetched):
+            if not fetched_refs:
+                continue
             repo_name = repo.name
             try:
-                self._update_git(cr, uid, repo)
+                self._update_git(cr, uid, repo, refs=None if fetched_refs is True else fetched_refs)
             except Exception:
                 _logger.exception('Fail to update repo %s', repo_name)
 
-    def _update_git(self, cr, uid, repo, context=None):
-        _logger.debug('repo %s updating branches', repo.name)
+    def _fetch_git_safe(self, repo_name, repo_path, hook_time, hook_refs=None):
+        try:
+            return self._fetch_git(repo_name, repo_path, hook_time, hook_refs)
+        except Exception:
+            _logger.exception('Fail to fetch repo %s', repo_name)
+            return False
 
-        Build = self.pool['runbot.build']
-        Branch = self.pool['runbot.branch']
+    def _fetch_git(self, repo_name, repo_path, hook_time, hook_refs=None):
+        """Clone or fetch a repository.
 
-        if not os.path.isdir(os.path.join(repo.path)):
-            os.makedirs(repo.path)
-        if not os.path.isdir(os.path.join(repo.path, 'refs')):
-            run(['git', 'clone', '--bare', repo.name, repo.path])
+        Return False if nothing had to be fetched, True if all refs were
+        fetched or the list of ref names fetched from ``hook_refs``, a list of
+        (ref name, sha, hook ref id) announced by webhooks.
+
+        Hook refs are handled once per host: the last hook ref id handled is
+        kept in the repository. When a hook ref cannot be fetched, e.g. it was
+        deleted from the remote since, all refs are fetched instead.
+
+        Only works on plain values so that it can be run outside of the cron thread.
+        """
+        t0 = time.time()
+        if not os.path.isdir(os.path.join(repo_path)):
+            os.makedirs(repo_path)
+        if not os.path.isdir(os.path.join(repo_path, 'refs')):
+            run(['git', 'clone', '--bare', repo_name, repo_path])
+
+        git = ['git', '--git-dir=%s' % repo_path]
 
         # check for mode == hook
-        fname_fetch_head = os.path.join(repo.path, 'FETCH_HEAD')
+        fname_fetch_head = os.path.join(repo_path, 'FETCH_HEAD')
         if os.path.isfile(fname_fetch_head):
             fetch_time = os.path.getmtime(fname_fetch_head)
-            if repo.mode == 'hook' and repo.hook_time and dt2time(repo.hook_time) < fetch_time:
-                t0 = time.time()
-                _logger.debug('repo %s skip hook fetch fetch_time: %ss ago hook_time: %ss ago',
-                              repo.name, int(t0 - fetch_time), int(t0 - dt2time(repo.hook_time)))
-                return
+            # a repo whose hooks all queued refs has no hook_time yet
+            if (hook_time and dt2time(hook_time) < fetch_time) or (not hook_time and hook_refs):
+                # only fetch the refs announced by webhooks this host does not have yet
+                fname_hook_id = os.path.join(repo_path, 'runbot_hook_id')
+                last_hook_id = 0
+                if os.path.isfile(fname_hook_id):
+                    with open(fname_hook_id) as f:
+                        last_hook_id = int(f.read().strip() or 0)
+                hook_refs = [ref for ref in hook_refs or [] if ref[2] > last_hook_id]
+                refs = []
+                if hook_refs:
+                    local_refs = subprocess.check_output(git + ['for-each-ref', '--format=%(refname) %(objectname)'])
+                    local_refs = dict(line.split(' ', 1) for line in local_refs.splitlines())
+                    refs = [name for name, sha, hook_id in hook_refs if local_refs.get(name) != sha]
+                    last_hook_id = max(hook_id for name, sha, hook_id in hook_refs)
+                try:
+                    for name in refs:
+                        refspec = '+%s:%s' % (name + '/head' if name.startswith('refs/pull/') else name, name)
+                        cmd = git + ['fetch', 'origin', refspec]
+                        _logger.info("git: %s", ' '.join(cmd))
+                        subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+                except subprocess.CalledProcessError as e:
+                    _logger.info('repo %s cannot fetch %s, fetching all refs: %s', repo_name, name, e.output)
+                else:
+                    with open(fname_hook_id, 'w') as f:
+                        f.write(str(last_hook_id))
+                    if refs:
+                        _logger.info('repo %s fetched %s hook refs in %.1fs', repo_name, len(refs), time.time() - t0)
+                        return refs
+                    _logger.debug('repo %s skip hook fetch fetch_time: %ss ago hook_time: %s',
+                                  repo_name, int(t0 - fetch_time), hook_time)
+                    return False
+
+        for refspec in ['+refs/heads/*:refs/heads/*', '+refs/pull/*/head:refs/pull/*']:
+            cmd = git + ['fetch', '-p', 'origin', refspec]
+            _logger.info("git: %s", ' '.join(cmd))
+            subprocess.check_output(cmd)
+        if hook_refs:
+            with open(os.path.join(repo_path, 'runbot_hook_id'), 'w') as f:
+                f.write(str(max(hook_id for name, sha, hook_id in hook_refs)))
+        _logger.info('repo %s fetched in %.1fs', repo_name, time.time() - t0)
+        return True
+
+    def _queue_hook(self, cr, uid, ids, event, payload, context=None):
+        """Queue the refs updated by a github push or pull_request event
+        payload for a targeted fetch, return whether a ref was queued.
 
-        repo._git(['fetch', '-p', 'origin', '+refs/heads/*:refs/heads/*'])
-        repo._git(['fetch', '-p', 'origin', '+refs/pull/*/head:refs/pull/*'])
+        Raise ValueError, KeyError or TypeError on a malformed payload.
+        """
+        refs = []
+        if event == 'push' and payload.get('ref', '').startswith('refs/heads/') and not payload.get('deleted'):
+            refs.append((payload['ref'], payload['after']))
+        elif event == 'pull_request' and payload.get('action') in ('opened', 'reopened', 'synchronize'):
+            refs.append(('refs/pull/%d' % int(payload['number']), payload['pull_request']['head']['sha']))
+        for name, sha in refs:
+            # both end up in git commands
+            if not (name.startswith('refs/pull/') or _re_branch_ref.match(name)) or not _re_sha.match(sha):
+                raise ValueError('invalid ref %r at %r' % (name, sha))
+        Hook = self.pool['runbot.hook.ref']
+        for repo_id in ids:
+            for name, sha in refs:
+                Hook.create(cr, uid, {'repo_id': repo_id, 'name': name, 'sha': sha}, context=context)
+        return bool(refs)
+
+    def _update_git(self, cr, uid, repo, refs=None, context=None):
+        """Create the branches and builds of the refs of repo that moved,
+        restricted to the ref names in refs if given"""
+        _logger.debug('repo %s updating branches', repo.name)
+
+        Build = self.pool['runbot.build']
+        Branch = self.pool['runbot.branch']
 
         fields = ['refname','objectname','committerdate:iso8601','authorname','authoremail','subject','committername','committeremail']
         fmt = "%00".join(["%("+field+")" for field in fields])
-        git_refs = repo._git(['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/heads', 'refs/pull'])
+        only_refs = refs
+        git_refs = repo._git(['for-each-ref', '--format', fmt, '--sort=-committerdate'] + (only_refs or ['refs/heads', 'refs/pull']))
         git_refs = git_refs.strip()
 
-        refs = [[decode_utf(field) for field in line.split('\x00')] for line in git_refs.split('\n')]
-
-        cr.execute("""
-            WITH t (branch) AS (SELECT unnest(%s))
-          SELECT t.branch, b.id
-            FROM t LEFT JOIN runbot_branch b ON (b.name = t.branch)
-           WHERE b.repo_id = %s;
-        """, ([r[0] for r in refs], repo.id))
-        ref_branches = {r[0]: r[1] for r in cr.fetchall()}
+        refs = [[decode_utf(field) for field in line.split('\x00')] for line in git_refs.split('\n')] if git_refs else []
 
+        # only reconcile refs that moved since the last update (branch head is the last seen sha)
+        if only_refs:
+            refs = [r for r in refs if r[0] in only_refs]
+            cr.execute("SELECT name, id, head, sticky FROM runbot_branch WHERE repo_id = %s AND name IN %s",
+                       [repo.id, tuple(only_refs)])
+        else:
+            cr.execute("SELECT name, id, head, sticky FROM runbot_branch WHERE repo_id = %s", [repo.id])
+        known_branches = {name: (branch_id, head, sticky) for name, branch_id, head, sticky in cr.fetchall()}
+        listed = set(r[0] for r in refs)
+        vanished_ids = [branch_id for name, (branch_id, head, sticky) in known_branches.iteritems()
+                        if head and name not in listed and not only_refs]
+        refs = [r for r in refs if known_branches.get(r[0], (None, None, None))[1] != r[1]]
+        _logger.debug('repo %s: %s refs moved, %s refs vanished', repo.name, len(refs), len(vanished_ids))
+
+        # create all new branches at once
+        new_refs = [r for r in refs if r[0] not in known_branches]
+        new_branch_ids = Branch._create_batch(cr, uid, [
+            {'repo_id': repo.id, 'name': r[0], 'head': r[1]} for r in new_refs
+        ], context=context)
+        ref_branches = {r[0]: branch_id for r, branch_id in zip(new_refs, new_branch_ids)}
+        sticky_branch_ids = set()
+        moved_heads = {}
+        for name, sha in (r[:2] for r in refs if r[0] in known_branches):
+            branch_id, head, sticky = known_branches[name]
+            ref_branches[name] = branch_id
+            moved_heads[branch_id] = sha
+            if sticky:
+                sticky_branch_ids.add(branch_id)
+
+        # skip build for old branches
+        limit_date = datetime.datetime.now() - datetime.timedelta(30)
+        refs = [r for r in refs if dateutil.parser.parse(r[2][:19]) >= limit_date]
+
+        # create build (and mark previous builds as skipped) if not found
+        existing_builds = set()
+        if refs:
+            cr.execute("""
+                SELECT b.branch_id, b.name
+                  FROM runbot_build b
+                  JOIN (SELECT unnest(%s::int[]) AS branch_id, unnest(%s::varchar[]) AS name) t
+                    ON (b.branch_id = t.branch_id AND b.name = t.name)
+            """, ([ref_branches[r[0]] for r in refs], [r[1] for r in refs]))
+            existing_builds = set(cr.fetchall())
+        new_builds = []
         for name, sha, date, author, author_email, subject, committer, committer_email in refs:
-            # create or get branch
-            if ref_branches.get(name):
-                branch_id = ref_branches[name]
-            else:
-                _logger.debug('repo %s found new branch %s', repo.name, name)
-                branch_id = Branch.create(cr, uid, {'repo_id': repo.id, 'name': name})
-            branch = Branch.browse(cr, uid, [branch_id], context=context)[0]
-            # skip build for old branches
-            if dateutil.parser.parse(date[:19]) + datetime.timedelta(30) < datetime.datetime.now():
+            if (ref_branches[name], sha) in existing_builds:
                 continue
-            # create build (and mark previous builds as skipped) if not found
-            build_ids = Build.search(cr, uid, [('branch_id', '=', branch.id), ('name', '=', sha)])
-            if not build_ids:
-                _logger.debug('repo %s branch %s new build found revno %s', branch.repo_id.name, branch.name, sha)
-                build_info = {
-                    'branch_id': branch.id,
-                    'name': sha,
-                    'author': author,
-                    'author_email': author_email,
-                    'committer': committer,
-                    'committer_email': committer_email,
-                    'subject': subject,
-                    'date': dateutil.parser.parse(date[:19]),
-                }
+            _logger.debug('repo %s branch %s new build found revno %s', repo.name, name, sha)
+            new_builds.append({
+                'branch_id': ref_branches[name],
+                'name': sha,
+                'author': author,
+                'author_email': author_email,
+                'committer': committer,
+                'committer_email': committer_email,
+                'subject': subject,
+                'date': dateutil.parser.parse(date[:19]),
+            })
 
-                if not branch.sticky:
-                    skipped_build_sequences = Build.search_read(cr, uid, [('branch_id', '=', branch.id), ('state', '=', 'pending')],
-                                                                fields=['sequence'], order='sequence asc', context=context)
-                    if skipped_build_sequences:
-                        to_be_skipped_ids = [build['id'] for build in skipped_build_sequences]
-                        Build._skip(cr, uid, to_be_skipped_ids, context=context)
-                        # new order keeps lowest skipped sequence
-                        build_info['sequence'] = skipped_build_sequences[0]['sequence']
-                Build.create(cr, uid, build_info)
+        # pending builds of non sticky branches are superseded by the new ones
+        superseded_branch_ids = [vals['branch_id'] for vals in new_builds
+                                 if vals['branch_id'] not in sticky_branch_ids]
+        if superseded_branch_ids:
+            to_be_skipped_ids = Build.search(cr, uid, [('branch_id', 'in', superseded_branch_ids),
+                                                       ('state', '=', 'pending')], context=context)
+            if to_be_skipped_ids:
+                Build._skip(cr, uid, to_be_skipped_ids, context=context)
+        Build._create_batch(cr, uid, new_builds, context=context)
+
+        # remember the reconciled heads for the next update
+        if moved_heads:
+            cr.execute("""
+                UPDATE runbot_branch b
+                   SET head = t.head,
+                       write_date = now() at time zone 'UTC'
+                  FROM (SELECT unnest(%s) AS id, unnest(%s) AS head) t
+                 WHERE b.id = t.id
+            """, (moved_heads.keys(), moved_heads.values()))
+        if vanished_ids:
+            cr.execute("UPDATE runbot_branch SET head = NULL, write_date = now() at time zone 'UTC' WHERE id IN %s",
+                       [tuple(vanished_ids)])
 
         # skip old builds (if their sequence number is too low, they will not ever be built)
         skippable_domain = [('repo_id', '=', repo.id), ('state', '=', 'pending')]
@@ -378,23 +903,14 @@ class runbot_repo(osv.osv):
         build_ids = Build.search(cr, uid, domain_host + [('state', 'in', ['testing', 'running', 'deathrow'])])
         Build._schedule(cr, uid, build_ids)
 
-        # launch new tests
+        # launch new tests, claiming atomically as many pending builds as free slots
+        workers = self.pool['runbot.host']._get_workers(cr, uid, host, workers)
         testing = Build.search_count(cr, uid, domain_host + [('state', '=', 'testing')])
-        pending = Build.search_count(cr, uid, domain + [('state', '=', 'pending')])
-
-        while testing < workers and pending > 0:
-
-            # find sticky pending build if any, otherwise, last pending (by id, not by sequence) will do the job
-            pending_ids = Build.search(cr, uid, domain + [('state', '=', 'pending'), ('branch_id.sticky', '=', True)], limit=1)
-            if not pending_ids:
-                pending_ids = Build.search(cr, uid, domain + [('state', '=', 'pending')], order="sequence", limit=1)
-
-            pending_build = Build.browse(cr, uid, pending_ids[0])
-            pending_build._schedule()
-
-            # compute the number of testing and pending jobs again
-            testing = Build.search_count(cr, uid, domain_host + [('state', '=', 'testing')])
-            pending = Build.search_count(cr, uid, domain + [('state', '=', 'pending')])
+        if testing < workers:
+            # the number of workers is a ceiling, the measured headroom decides
+            slots = self.pool['runbot.host']._admissible(cr, uid, host, workers - testing)
+            claimed_ids = Build._claim(cr, uid, ids, host, slots)
+            Build._run_job(cr, uid, claimed_ids)
 
         # terminate and reap doomed build
         build_ids = Build.search(cr, uid, domain_host + [('state', '=', 'running')])
@@ -418,19 +934,35 @@ class runbot_repo(osv.osv):
         settings['runbot_static'] = os.path.join(get_module_resource('runbot', 'static'), '')
         nginx_dir = os.path.join(self._root(cr, uid), 'nginx')
         settings['nginx_dir'] = nginx_dir
-        settings['re_escape'] = re.escape
         ids = self.search(cr, uid, [('nginx','=',True)], order='id')
         if ids:
-            build_ids = self.pool['runbot.build'].search(cr, uid, [('repo_id','in',ids), ('state','=','running')])
-            settings['builds'] = self.pool['runbot.build'].browse(cr, uid, build_ids)
+            # running builds are looked up by host in maps, so that only the
+            # maps change when builds start or stop
+            cr.execute("""
+                SELECT dest, port
+                  FROM runbot_build
+                 WHERE repo_id IN %s
+                   AND state = 'running'
+              ORDER BY dest
+            """, [tuple(ids)])
+            builds = cr.fetchall()
+            nginx_maps = ''.join(
+                'map $host $%s {\n    default "";\n%s}\n' % (name, ''.join(
+                    '    "~^%s[-.]" %d;\n' % (re.escape(dest), port + offset) for dest, port in builds))
+                for name, offset in [('runbot_build_port', 0), ('runbot_build_longpolling_port', 1)])
 
             nginx_config = self.pool['ir.ui.view'].render(cr, uid, "runbot.nginx_config", settings)
             mkdirs([nginx_dir])
-            open(os.path.join(nginx_dir, 'nginx.conf'),'w').write(nginx_config)
+            changed = update_file(os.path.join(nginx_dir, 'builds.map'), nginx_maps)
+            changed = update_file(os.path.join(nginx_dir, 'nginx.conf'), nginx_config) or changed
             try:
-                _logger.debug('reload nginx')
                 pid = int(open(os.path.join(nginx_dir, 'nginx.pid')).read().strip(' \n'))
-                os.kill(pid, signal.SIGHUP)
+                if changed:
+                    _logger.debug('reload nginx')
+                    os.kill(pid, signal.SIGHUP)
+                else:
+                    # check that nginx is still running
+                    os.kill(pid, 0)
             except Exception:
                 _logger.debug('start nginx')
                 if run(['/usr/sbin/nginx', '-p', nginx_dir, '-c', 'nginx.conf']):
@@ -455,6 +987,271 @@ class runbot_repo(osv.osv):
         if uid == SUPERUSER_ID:
             return self._cron(cr, uid, ids=ids, context=context)
 
+class runbot_host(osv.osv):
+    _name = "runbot.host"
+    _order = 'name'
+
+    _columns = {
+        'name': fields.char('Host', required=True, select=1),
+        'nb_worker': fields.integer('Workers', help="Maximum number of builds tested at the same time on this host, "
+                                                   "0 to use the global number of workers"),
+        'last_seen': fields.datetime('Last seen'),
+        'max_load': fields.float('Max load', help="Maximum 1 minute load average per CPU to start new builds, "
+                                                  "0 to ignore the load"),
+        'min_memory': fields.integer('Min memory (MiB)', help="Memory kept available besides the memory "
+                                                              "needed by the builds started"),
+        'min_disk': fields.integer('Min disk (MiB)', help="Disk space under the runbot root required to start builds"),
+        'cpu': fields.integer('CPUs', readonly=True),
+        'load': fields.float('Load', readonly=True),
+        'memory_available': fields.integer('Available memory (MiB)', readonly=True),
+        'disk_available': fields.integer('Available disk (MiB)', readonly=True),
+    }
+    _defaults = {
+        'max_load': 1.0,
+        'min_memory': 1024,
+        'min_disk': 5120,
+    }
+    _sql_constraints = [
+        ('name_unique', 'unique(name)', 'Host name must be unique'),
+    ]
+
+    def _get_workers(self, cr, uid, name, default, context=None):
+        """Return the capacity of host name, registering the host if needed"""
+        cr.execute("""
+            UPDATE runbot_host
+               SET last_seen = now() at time zone 'UTC'
+             WHERE name = %s
+         RETURNING nb_worker
+        """, [name])
+        row = cr.fetchone()
+        if not row:
+            self.create(cr, uid, {'name': name, 'last_seen': now()}, context=context)
+            return default
+        return row[0] or default
+
+    def _admissible(self, cr, uid, name, limit, context=None):
+        """Return how many builds, up to limit, host name can start given its
+        measured CPU, memory and disk headroom"""
+        root = self.pool['runbot.repo']._root(cr, uid)
+        cpu, load, memory, disk = host_resources(root)
+        memory //= 1024
+        disk //= 1024
+        cr.execute("""
+            UPDATE runbot_host
+               SET cpu = %s, load = %s, memory_available = %s, disk_available = %s
+             WHERE name = %s
+         RETURNING max_load, min_memory, min_disk
+        """, [cpu, load, memory, disk, name])
+        row = cr.fetchone()
+        if not row:
+            return limit
+        max_load, min_memory, min_disk = row
+
+        if disk < (min_disk or 0):
+            _logger.info('host %s: %s MiB of disk available, not starting builds', name, disk)
+            return 0
+
+        # builds started during the last minute are not in the load average yet
+        cr.execute("""
+            SELECT count(*)
+              FROM runbot_build
+             WHERE host = %s
+               AND state = 'testing'
+               AND job_start > (now() at time zone 'UTC') - interval '1 minute'
+        """, [name])
+        recent = cr.fetchone()[0]
+        if max_load:
+            limit = min(limit, int(max_load * cpu - load - recent))
+
+        # memory needed by a build, as measured on recent test_all jobs
+        cr.execute("""
+            SELECT avg(max_rss)
+              FROM (SELECT max_rss
+                      FROM runbot_build_usage
+                     WHERE host = %s
+                       AND job = 'job_20_test_all'
+                       AND done
+                  ORDER BY id DESC
+                     LIMIT 20) u
+        """, [name])
+        build_memory = max(1, (cr.fetchone()[0] or 1024 * 1024) // 1024)
+        limit = min(limit, int((memory - (min_memory or 0)) // build_memory) - recent)
+
+        if limit <= 0:
+            _logger.debug('host %s: no headroom (load %s, %s MiB available)', name, load, memory)
+        return max(limit, 0)
+
+class runbot_port(osv.osv):
+    _name = "runbot.port"
+    _order = 'host, port'
+    _log_access = False
+
+    _columns = {
+        'host': fields.char('Host', required=True),
+        'port': fields.integer('Port', required=True),
+        'build_id': fields.many2one('runbot.build', 'Build', ondelete='set null', select=1),
+    }
+    _sql_constraints = [
+        ('host_port_unique', 'unique(host, port)', 'Port already allocated on this host'),
+    ]
+
+    def _assign(self, cr, uid, host, build_id, context=None):
+        """Assign a port of host to build_id and return it.
+
+        The lowest released port is reused, otherwise the port following the
+        highest one allocated on the host is added. Ports on which something
+        else listens are left aside. Builds use their port and the next one,
+        so ports stop at 65534.
+        """
+        icp = self.pool['ir.config_parameter']
+        starting_port = int(icp.get_param(cr, uid, 'runbot.starting_port', default=2000))
+        busy = [0]
+        while True:
+            cr.execute("""
+                UPDATE runbot_port
+                   SET build_id = %s
+                 WHERE id = (SELECT id
+                               FROM runbot_port
+                              WHERE host = %s
+                                AND build_id IS NULL
+                                AND port >= %s
+                                AND port NOT IN %s
+                           ORDER BY port
+                              LIMIT 1
+                                FOR UPDATE SKIP LOCKED)
+             RETURNING port
+            """, [build_id, host, starting_port, tuple(busy)])
+            row = cr.fetchone()
+            if not row:
+                cr.execute("SELECT GREATEST(max(port) + 2, %s) FROM runbot_port WHERE host = %s", [starting_port, host])
+                next_port = cr.fetchone()[0]
+                if next_port > 65534:
+                    raise Exception('no port left on %s above %s' % (host, starting_port))
+                cr.execute("""
+                    INSERT INTO runbot_port (host, port, build_id)
+                         VALUES (%s, %s, %s)
+                    ON CONFLICT DO NOTHING
+                      RETURNING port
+                """, [host, next_port, build_id])
+                row = cr.fetchone()
+                if not row:
+                    # allocated concurrently by another worker
+                    continue
+            port = row[0]
+            if port_free(port) and port_free(port + 1):
+                return port
+            busy.append(port)
+            cr.execute("UPDATE runbot_port SET build_id = NULL WHERE host = %s AND port = %s", [host, port])
+
+    def _release(self, cr, uid, build_ids, keep_build_port=False, context=None):
+        """Release the ports assigned to build_ids, except the port of the
+        builds themselves if keep_build_port is set"""
+        if keep_build_port:
+            cr.execute("""
+                UPDATE runbot_port p
+                   SET build_id = NULL
+                  FROM runbot_build b
+                 WHERE p.build_id = b.id
+                   AND b.id IN %s
+                   AND p.port != b.port
+            """, [tuple(build_ids)])
+        else:
+            cr.execute("UPDATE runbot_port SET build_id = NULL WHERE build_id IN %s", [tuple(build_ids)])
+
+class runbot_closest_branch(osv.osv):
+    _name = "runbot.closest.branch"
+
+    _columns = {
+        'branch_id': fields.many2one('runbot.branch', 'Branch', required=True, ondelete='cascade', select=1),
+        'sha': fields.char('Sha', required=True),
+        'target_repo_id': fields.many2one('runbot.repo', 'Target Repository', required=True, ondelete='cascade'),
+        'snapshot': fields.char('Snapshot', help="Hash of the branches the resolution depends on"),
+        'result_repo_id': fields.many2one('runbot.repo', 'Closest Repository', ondelete='cascade'),
+        'result_name': fields.char('Closest Branch'),
+        'match': fields.char('Match'),
+    }
+
+    def init(self, cr):
+        # one resolution per key, see runbot_build._get_closest_branch_name
+        cr.execute("""
+            DELETE FROM runbot_closest_branch c
+             WHERE EXISTS (SELECT 1
+                             FROM runbot_closest_branch d
+                            WHERE d.branch_id = c.branch_id
+                              AND d.sha = c.sha
+                              AND d.target_repo_id = c.target_repo_id
+                              AND d.id > c.id)
+        """)
+        cr.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS runbot_closest_branch_unique_index
+                ON runbot_closest_branch (branch_id, sha, target_repo_id)
+        """)
+
+    def _store(self, cr, uid, branch_id, sha, target_repo_id, snapshot, result, context=None):
+        """Store the resolution result of sha of branch_id for target_repo_id"""
+        cr.execute("""
+            INSERT INTO runbot_closest_branch (branch_id, sha, target_repo_id, snapshot,
+                                               result_repo_id, result_name, match,
+                                               create_uid, create_date, write_uid, write_date)
+                 VALUES (%(branch_id)s, %(sha)s, %(target_repo_id)s, %(snapshot)s,
+                         %(result_repo_id)s, %(result_name)s, %(match)s,
+                         %(uid)s, now() at time zone 'UTC', %(uid)s, now() at time zone 'UTC')
+            ON CONFLICT (branch_id, sha, target_repo_id) DO UPDATE
+                    SET snapshot = EXCLUDED.snapshot,
+                        result_repo_id = EXCLUDED.result_repo_id,
+                        result_name = EXCLUDED.result_name,
+                        match = EXCLUDED.match,
+                        write_uid = EXCLUDED.write_uid,
+                        write_date = EXCLUDED.write_date
+        """, {
+            'branch_id': branch_id,
+            'sha': sha,
+            'target_repo_id': target_repo_id,
+            'snapshot': snapshot,
+            'result_repo_id': result[0],
+            'result_name': result[1],
+            'match': result[2],
+            'uid': uid,
+        })
+
+    def _purge(self, cr, uid, context=None):
+        """Delete the resolutions of the shas which are no longer the head of
+        their branch"""
+        cr.execute("""
+            DELETE FROM runbot_closest_branch c
+                  USING runbot_branch b
+                  WHERE b.id = c.branch_id
+                    AND c.sha IS DISTINCT FROM b.head
+        """)
+
+class runbot_github_status(osv.osv):
+    _name = "runbot.github.status"
+    _order = 'id'
+
+    _columns = {
+        'repo_id': fields.many2one('runbot.repo', 'Repository', required=True, ondelete='cascade'),
+        'sha': fields.char('Sha', required=True),
+        'context': fields.char('Context', required=True),
+        'state': fields.char('State'),
+        'target_url': fields.char('Target URL'),
+        'description': fields.char('Description'),
+        'attempts': fields.integer('Attempts'),
+        'next_try': fields.datetime('Next Try', select=1),
+    }
+    _sql_constraints = [
+        ('status_unique', 'unique(repo_id, sha, context)', 'Only the last status of a context is kept'),
+    ]
+
+class runbot_hook_ref(osv.osv):
+    _name = "runbot.hook.ref"
+    _order = 'id desc'
+
+    _columns = {
+        'repo_id': fields.many2one('runbot.repo', 'Repository', required=True, ondelete='cascade', select=1),
+        'name': fields.char('Ref Name', required=True),
+        'sha': fields.char('Sha', required=True),
+    }
+
 class runbot_branch(osv.osv):
     _name = "runbot.branch"
     _order = 'name'
@@ -496,6 +1293,7 @@ class runbot_branch(osv.osv):
     _columns = {
         'repo_id': fields.many2one('runbot.repo', 'Repository', required=True, ondelete='cascade', select=1),
         'name': fields.char('Ref Name', required=True),
+        'head': fields.char('Head', help="Last sha of the ref reconciled by the repo update"),
         'branch_name': fields.function(_get_branch_name, type='char', string='Branch', readonly=1, store=True),
         'branch_url': fields.function(_get_branch_url, type='char', string='Branch url', readonly=1),
         'pull_head_name': fields.function(_get_pull_head_name, type='char', string='PR HEAD name', readonly=1, store=True),
@@ -504,6 +1302,8 @@ class runbot_branch(osv.osv):
         'state': fields.char('Status'),
         'modules': fields.char("Modules to Install", help="Comma-separated list of modules to install and test."),
         'job_timeout': fields.integer('Job Timeout (minutes)', help='For default timeout: Mark it zero'),
+        'test_shards': fields.integer('Test Shards', help="Number of servers installing and testing the modules in "
+                                                          "parallel, each in its own database. 0 or 1 to use a single one"),
     }
 
     def _get_pull_info(self, cr, uid, ids, context=None):
@@ -530,6 +1330,44 @@ class runbot_branch(osv.osv):
         values.setdefault('coverage', _re_coverage.search(values.get('name') or '') is not None)
         return super(runbot_branch, self).create(cr, uid, values, context=context)
 
+    def _create_batch(self, cr, uid, vals_list, context=None):
+        """Create the branches described by vals_list (repo_id, name and head
+        only) with a single INSERT and return their ids in the same order"""
+        if not vals_list:
+            return []
+        for vals in vals_list:
+            _logger.debug('repo %s found new branch %s', vals['repo_id'], vals['name'])
+        cr.execute("""
+            INSERT INTO runbot_branch (create_uid, create_date, write_uid, write_date,
+                                       repo_id, name, head, branch_name, coverage)
+                 SELECT %s, now() at time zone 'UTC', %s, now() at time zone 'UTC',
+                        unnest(%s::int[]), unnest(%s::varchar[]), unnest(%s::varchar[]),
+                        unnest(%s::varchar[]), unnest(%s::boolean[])
+              RETURNING repo_id, name, id
+        """, (uid, uid,
+              [vals['repo_id'] for vals in vals_list],
+              [vals['name'] for vals in vals_list],
+              [vals.get('head') for vals in vals_list],
+              [vals['name'].split('/')[-1] for vals in vals_list],
+              [_re_coverage.search(vals['name']) is not None for vals in vals_list]))
+        created = {(repo_id, name): branch_id for repo_id, name, branch_id in cr.fetchall()}
+        ids = [created[(vals['repo_id'], vals['name'])] for vals in vals_list]
+
+        # pull_head_name is a stored function field, fill it as create() would
+        pull_ids = [branch_id for vals, branch_id in zip(vals_list, ids)
+                    if vals['name'].startswith('refs/pull/')]
+        pull_head_names = self._get_pull_head_name(cr, uid, pull_ids, 'pull_head_name', None, context=context)
+        pull_head_names = {k: v for k, v in pull_head_names.iteritems() if v}
+        if pull_head_names:
+            cr.execute("""
+                UPDATE runbot_branch b
+                   SET pull_head_name = t.pull_head_name,
+                       write_date = now() at time zone 'UTC'
+                  FROM (SELECT unnest(%s::int[]) AS id, unnest(%s::varchar[]) AS pull_head_name) t
+                 WHERE b.id = t.id
+            """, (pull_head_names.keys(), pull_head_names.values()))
+        return ids
+
 class runbot_build(osv.osv):
     _name = "runbot.build"
     _order = 'id desc'
@@ -537,53 +1375,36 @@ class runbot_build(osv.osv):
     def _get_dest(self, cr, uid, ids, field_name, arg, context=None):
         r = {}
         for build in self.browse(cr, uid, ids, context=context):
-            nickname = dashes(build.branch_id.name.split('/')[2])[:32]
-            r[build.id] = ("%05d-%s-%s" % (build.id, nickname, build.name[:6])).lower()
+            r[build.id] = build_dest(build.id, build.branch_id.name, build.name)
         return r
 
-    def _get_time(self, cr, uid, ids, field_name, arg, context=None):
-        """Return the time taken by the tests"""
-        r = {}
-        for build in self.browse(cr, uid, ids, context=context):
-            r[build.id] = 0
-            if build.job_end:
-                r[build.id] = int(dt2time(build.job_end) - dt2time(build.job_start))
-            elif build.job_start:
-                r[build.id] = int(time.time() - dt2time(build.job_start))
-        return r
-
-    def _get_age(self, cr, uid, ids, field_name, arg, context=None):
-        """Return the time between job start and now"""
-        r = {}
-        for build in self.browse(cr, uid, ids, context=context):
-            r[build.id] = 0
-            if build.job_start:
-                r[build.id] = int(time.time() - dt2time(build.job_start))
-        return r
+    def _get_time(self, cr, uid, ids, field_names, arg, context=None):
+        """Return the time taken by the tests (job_time) and the time between
+        job start and now (job_age)"""
+        cr.execute("""
+            SELECT b.id, {job_time}, {job_age}
+              FROM runbot_build b
+             WHERE b.id IN %s
+        """.format(job_time=_sql_job_time, job_age=_sql_job_age), [tuple(ids)])
+        return dict((r[0], {'job_time': r[1], 'job_age': r[2]}) for r in cr.fetchall())
 
     def _get_domain(self, cr, uid, ids, field_name, arg, context=None):
-        result = {}
         domain = self.pool['runbot.repo']._domain(cr, uid)
-        for build in self.browse(cr, uid, ids, context=context):
-            if build.repo_id.nginx:
-                result[build.id] = "%s.%s" % (build.dest, build.host)
-            else:
-                result[build.id] = "%s:%s" % (domain, build.port)
-        return result
+        cr.execute("""
+            SELECT b.id, {domain}
+              FROM runbot_build b
+              JOIN runbot_repo r ON (r.id = b.repo_id)
+             WHERE b.id IN %(ids)s
+        """.format(domain=_sql_domain), {'domain': domain, 'ids': tuple(ids)})
+        return dict(cr.fetchall())
 
     def _guess_result(self, cr, uid, ids, field_nae, arg, context=None):
+        # the counters are maintained while the test_all log is scanned
         cr.execute("""
-            SELECT b.id,
-                   CASE WHEN b.state != 'testing' THEN b.result
-                        WHEN array_agg(l.level)::text[] && ARRAY['ERROR', 'CRITICAL'] THEN 'ko'
-                        WHEN array_agg(l.level)::text[] && ARRAY['WARNING'] THEN 'warn'
-                        ELSE 'ok'
-                    END
+            SELECT b.id, {guess_result}
               FROM runbot_build b
-         LEFT JOIN ir_logging l ON (l.build_id = b.id AND l.level != 'INFO')
              WHERE b.id IN %s
-          GROUP BY b.id
-        """, [tuple(ids)])
+        """.format(guess_result=_sql_guess_result), [tuple(ids)])
         return dict(cr.fetchall())
 
     _columns = {
@@ -620,9 +1441,15 @@ class runbot_build(osv.osv):
         'job': fields.char('Job'), # job_*
         'job_start': fields.datetime('Job start'),
         'job_end': fields.datetime('Job end'),
-        'job_time': fields.function(_get_time, type='integer', string='Job time'),
-        'job_age': fields.function(_get_age, type='integer', string='Job age'),
+        'job_time': fields.function(_get_time, type='integer', string='Job time', multi='time'),
+        'job_age': fields.function(_get_time, type='integer', string='Job age', multi='time'),
         'duplicate_id': fields.many2one('runbot.build', 'Corresponding Build'),
+        'log_offset': fields.integer('Log offset'),
+        'log_shard_offsets': fields.char('Log offsets of the test shards'),
+        'log_errors': fields.integer('Log errors'),
+        'log_warnings': fields.integer('Log warnings'),
+        'log_loaded': fields.boolean('Modules loaded'),
+        'log_shutdown': fields.boolean('Shutdown initiated'),
         'server_match': fields.selection([('builtin', 'This branch includes Odoo server'),
                                           ('exact', 'branch/PR exact name'),
                                           ('prefix', 'branch whose name is a prefix of current one'),
@@ -636,13 +1463,62 @@ class runbot_build(osv.osv):
         'result': '',
     }
 
+    def init(self, cr):
+        # pending builds are looked up by repo for each claim
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_build_pending_index
+                ON runbot_build (repo_id, sequence)
+             WHERE state = 'pending'
+        """)
+        # build feed, see _feed: every write stamps the build with the id of
+        # its transaction
+        cr.execute("""
+            ALTER TABLE runbot_build ADD COLUMN IF NOT EXISTS feed_txid bigint NOT NULL DEFAULT 0;
+            CREATE OR REPLACE FUNCTION runbot_build_feed_txid() RETURNS trigger AS $$
+            BEGIN
+                NEW.feed_txid := txid_current();
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            DROP TRIGGER IF EXISTS runbot_build_feed_txid ON runbot_build;
+            CREATE TRIGGER runbot_build_feed_txid BEFORE INSERT OR UPDATE ON runbot_build
+                FOR EACH ROW EXECUTE PROCEDURE runbot_build_feed_txid();
+            DROP INDEX IF EXISTS runbot_build_write_date_index;
+            CREATE INDEX IF NOT EXISTS runbot_build_feed_txid_index
+                ON runbot_build (feed_txid, id)
+        """)
+        # active builds are counted by repo and host on every page
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_build_active_index
+                ON runbot_build (repo_id, host, state)
+             WHERE state IN ('testing', 'running')
+        """)
+        # register the ports of the builds started before the port table
+        cr.execute("""
+            INSERT INTO runbot_port (host, port, build_id)
+                 SELECT host, port, id
+                   FROM runbot_build
+                  WHERE state NOT IN ('pending', 'done', 'duplicate')
+                    AND host IS NOT NULL
+                    AND port IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM runbot_port)
+            ON CONFLICT DO NOTHING
+        """)
+
+    def write(self, cr, uid, ids, values, context=None):
+        res = super(runbot_build, self).write(cr, uid, ids, values, context=context)
+        if values.get('state') in ('pending', 'done', 'duplicate') and ids:
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            self.pool['runbot.port']._release(cr, uid, ids, context=context)
+        return res
+
     def create(self, cr, uid, values, context=None):
         build_id = super(runbot_build, self).create(cr, uid, values, context=context)
         build = self.browse(cr, uid, build_id)
         extra_info = {'sequence' : build_id}
 
         # detect duplicate
-        duplicate_id = None
         domain = [
             ('repo_id','=',build.repo_id.duplicate_id.id), 
             ('name', '=', build.name), 
@@ -650,6 +1526,17 @@ class runbot_build(osv.osv):
             '|', ('result', '=', False), ('result', '!=', 'skipped')
         ]
         duplicate_ids = self.search(cr, uid, domain, context=context)
+        duplicate_id = self._find_duplicate(cr, uid, build_id, duplicate_ids, context=context)
+        if duplicate_id:
+            extra_info.update({'state': 'duplicate', 'duplicate_id': duplicate_id})
+            self.write(cr, uid, [duplicate_id], {'duplicate_id': build_id})
+        self.write(cr, uid, [build_id], extra_info, context=context)
+        return build_id
+
+    def _find_duplicate(self, cr, uid, build_id, duplicate_ids, context=None):
+        """Return the build among duplicate_ids that build_id duplicates, if any"""
+        build = self.browse(cr, uid, build_id, context=context)
+        duplicate_id = None
         for duplicate in self.browse(cr, uid, duplicate_ids, context=context):
             duplicate_id = duplicate.id
             # Consider the duplicate if its closest branches are the same than the current build closest branches.
@@ -658,11 +1545,75 @@ class runbot_build(osv.osv):
                 duplicate_closest_name = duplicate._get_closest_branch_name(extra_repo.id)[1]
                 if build_closest_name != duplicate_closest_name:
                     duplicate_id = None
-        if duplicate_id:
-            extra_info.update({'state': 'duplicate', 'duplicate_id': duplicate_id})
-            self.write(cr, uid, [duplicate_id], {'duplicate_id': build_id})
-        self.write(cr, uid, [build_id], extra_info, context=context)
-        return build_id
+        return duplicate_id
+
+    def _create_batch(self, cr, uid, vals_list, context=None):
+        """Create the pending builds described by vals_list with a constant
+        number of queries and return their ids.
+
+        Same result as calling create() for each values, but rows are
+        inserted at once and duplicate candidates are resolved in one query.
+        Only the values set by the repo update are supported.
+        """
+        if not vals_list:
+            return []
+        columns = ['name', 'author', 'author_email', 'committer', 'committer_email', 'subject']
+        cr.execute("""
+            INSERT INTO runbot_build (create_uid, create_date, write_uid, write_date, state, result,
+                                      branch_id, repo_id, date, %s)
+                 SELECT %%(uid)s, now() at time zone 'UTC', %%(uid)s, now() at time zone 'UTC', 'pending', '',
+                        t.branch_id, br.repo_id, t.date, %s
+                   FROM (SELECT unnest(%%(branch_id)s::int[]) AS branch_id,
+                                unnest(%%(date)s::timestamp[]) AS date,
+                                %s) t
+                   JOIN runbot_branch br ON (br.id = t.branch_id)
+              RETURNING id
+        """ % (', '.join(columns),
+               ', '.join('t.%s' % c for c in columns),
+               ', '.join('unnest(%%(%s)s::varchar[]) AS %s' % (c, c) for c in columns)),
+        dict({c: [vals.get(c) for vals in vals_list] for c in columns + ['branch_id', 'date']}, uid=uid))
+        ids = [r[0] for r in cr.fetchall()]
+
+        # stored fields computed by create(): dest and sequence
+        cr.execute("""
+            SELECT bu.id, bu.name, br.name, bu.repo_id, r.duplicate_id
+              FROM runbot_build bu
+              JOIN runbot_branch br ON (br.id = bu.branch_id)
+              JOIN runbot_repo r ON (r.id = bu.repo_id)
+             WHERE bu.id IN %s
+        """, [tuple(ids)])
+        builds = cr.fetchall()
+        cr.execute("""
+            UPDATE runbot_build b
+               SET dest = t.dest, sequence = b.id
+              FROM (SELECT unnest(%s::int[]) AS id, unnest(%s::varchar[]) AS dest) t
+             WHERE b.id = t.id
+        """, ([b[0] for b in builds], [build_dest(b[0], b[2], b[1]) for b in builds]))
+
+        # detect duplicates
+        candidates = {}
+        to_check = [b for b in builds if b[4]]
+        if to_check:
+            cr.execute("""
+                SELECT d.id, d.repo_id, d.name
+                  FROM runbot_build d
+                  JOIN (SELECT unnest(%s::int[]) AS repo_id, unnest(%s::varchar[]) AS name) t
+                    ON (d.repo_id = t.repo_id AND d.name = t.name)
+                 WHERE d.duplicate_id IS NULL
+                   AND (d.result IS NULL OR d.result != 'skipped')
+              ORDER BY d.id DESC
+            """, ([b[4] for b in to_check], [b[1] for b in to_check]))
+            for duplicate_id, repo_id, name in cr.fetchall():
+                candidates.setdefault((repo_id, name), []).append(duplicate_id)
+        for build_id, name, branch_name, repo_id, duplicate_repo_id in to_check:
+            duplicate_ids = candidates.get((duplicate_repo_id, name))
+            duplicate_id = duplicate_ids and self._find_duplicate(cr, uid, build_id, duplicate_ids, context=context)
+            if duplicate_id:
+                # its duplicate_id is set below, it is no longer a candidate
+                duplicate_ids.remove(duplicate_id)
+                self.write(cr, uid, [build_id], {'state': 'duplicate', 'duplicate_id': duplicate_id}, context=context)
+                self.write(cr, uid, [duplicate_id], {'duplicate_id': build_id}, context=context)
+        return ids
 
     def _reset(self, cr, uid, ids, context=None):
         self.write(cr, uid, ids, { 'state' : 'pending' }, context=context)
@@ -676,22 +1627,170 @@ class runbot_build(osv.osv):
     def _list_jobs(self):
         return sorted(job[1:] for job in dir(self) if _re_job.match(job))
 
-    def _find_port(self, cr, uid):
-        # currently used port
-        ids = self.search(cr, uid, [('state','not in',['pending','done'])])
-        ports = set(i['port'] for i in self.read(cr, uid, ids, ['port']))
+    def _stats(self, cr, uid, context=None):
+        """Return the number of pending, testing and running builds by repo and
+        by host and repo as {'repos': {repo_id: {state: count}}, 'hosts': {host:
+        {repo_id: {state: count}}}}, computed in one query at most every
+        _stats_ttl seconds, for all repos whatever the access rights.
 
-        # starting port
-        icp = self.pool['ir.config_parameter']
-        port = int(icp.get_param(cr, uid, 'runbot.starting_port', default=2000))
+        Hosts seen by the scheduler during the last 10 minutes are listed
+        even without builds.
+        """
+        cached = _stats_cache.get(cr.dbname)
+        if cached and cached[0] > time.time():
+            return cached[1]
+        cr.execute("""
+            SELECT repo_id, host, state, count(*)
+              FROM runbot_build
+             WHERE state IN ('pending', 'testing', 'running')
+          GROUP BY repo_id, host, state
+         UNION ALL
+            SELECT NULL, name, NULL, 0
+              FROM runbot_host
+             WHERE last_seen > (now() at time zone 'UTC') - interval '10 minutes'
+        """)
+        stats = {'repos': {}, 'hosts': {}}
+        for repo_id, host, state, count in cr.fetchall():
+            if host:
+                stats['hosts'].setdefault(host, {})
+            if not repo_id:
+                continue
+            counts = stats['repos'].setdefault(repo_id, dict.fromkeys(['pending', 'testing', 'running'], 0))
+            counts[state] += count
+            if host:
+                counts = stats['hosts'][host].setdefault(repo_id, dict.fromkeys(['pending', 'testing', 'running'], 0))
+                counts[state] += count
+        _stats_cache[cr.dbname] = (time.time() + _stats_ttl, stats)
+        return stats
+
+    def _stats_info(self, cr, uid, repo_ids, context=None):
+        """Return the counters of _stats for the pages and the API: the
+        counters of repo_ids, the total of the pending builds and the counters
+        of each host as a list sorted by host. The totals only count the repos
+        uid can read."""
+        stats = self._stats(cr, uid, context=context)
+        visible_ids = self.pool['runbot.repo'].search(cr, uid, [], context=context)
+        no_builds = dict.fromkeys(['pending', 'testing', 'running'], 0)
+        repos = dict((repo_id, stats['repos'].get(repo_id, no_builds)) for repo_id in repo_ids)
+        host_stats = []
+        for host, host_repos in sorted(stats['hosts'].items()):
+            counts = dict(no_builds, host=host)
+            for repo_id in visible_ids:
+                for state, count in host_repos.get(repo_id, no_builds).items():
+                    counts[state] += count
+            host_stats.append(counts)
+        return {
+            'repos': repos,
+            'pending_total': sum(stats['repos'].get(repo_id, no_builds)['pending'] for repo_id in visible_ids),
+            'host_stats': host_stats,
+        }
+
+    def _feed(self, cr, uid, repo_ids, since=None, limit=200, context=None):
+        """Return the builds of repo_ids written after the cursor since and the
+        cursor to use for the next call.
+
+        The cursor is the (feed_txid, id) of the last build returned, without
+        since the last limit builds written are returned. Builds are returned
+        as dicts of their displayed values, in the order they were written.
 
-        # find next free port
-        while port in ports:
-            port += 2
+        Only the writes of the transactions older than the oldest one still
+        running on this database are returned, so that a transaction
+        committing late cannot slip behind the cursor. The transactions of the
+        other databases of the cluster (e.g. the builds' databases) are not
+        waited for, but the feed lags behind the transactions of the runbot
+        itself, e.g. the scheduler while a build is being checked out.
+        """
+        if not repo_ids:
+            return [], since
+        domain = self.pool['runbot.repo']._domain(cr, uid)
+        cr.execute("""
+            SELECT * FROM (
+                SELECT b.id, b.repo_id, b.branch_id, br.branch_name, b.name, b.dest,
+                       b.state, b.result, {guess_result} AS guess_result,
+                       b.job, b.host, b.port, {domain} AS domain,
+                       {job_time} AS job_time, {job_age} AS job_age,
+                       b.subject, b.author, b.committer, b.sequence, b.duplicate_id,
+                       b.write_date, b.feed_txid
+                  FROM runbot_build b
+                  JOIN runbot_branch br ON (br.id = b.branch_id)
+                  JOIN runbot_repo r ON (r.id = b.repo_id)
+                 WHERE b.repo_id IN %(repo_ids)s
+                   AND b.feed_txid < (SELECT coalesce(min(x.txid), txid_snapshot_xmax(txid_current_snapshot()))
+                                        FROM txid_snapshot_xip(txid_current_snapshot()) x(txid)
+                                        JOIN pg_stat_activity a
+                                          ON (a.backend_xid::text::bigint = x.txid %% 4294967296)
+                                       WHERE a.datname = current_database())
+                   AND (%(since_txid)s IS NULL OR (b.feed_txid, b.id) > (%(since_txid)s, %(since_id)s))
+              ORDER BY b.feed_txid {order}, b.id {order}
+                 LIMIT %(limit)s
+            ) builds
+            ORDER BY feed_txid, id
+        """.format(guess_result=_sql_guess_result, domain=_sql_domain,
+                   job_time=_sql_job_time, job_age=_sql_job_age,
+                   order='ASC' if since else 'DESC'), {
+            'domain': domain,
+            'repo_ids': tuple(repo_ids),
+            'since_txid': since and since[0],
+            'since_id': since and since[1],
+            'limit': limit,
+        })
+        columns = [d[0] for d in cr.description]
+        builds = [dict(zip(columns, row)) for row in cr.fetchall()]
+        if builds:
+            since = (builds[-1].pop('feed_txid'), builds[-1]['id'])
+            for build in builds:
+                build.pop('feed_txid', None)
+        return builds, since
 
-        return port
+    def _find_port(self, cr, uid, build_id, host, context=None):
+        return self.pool['runbot.port']._assign(cr, uid, host, build_id, context=context)
+
+    def _get_target_repo_ids(self, cr, uid, target_repo_id, context=None):
+        """Return target_repo_id followed by its chain of duplicated repos"""
+        target_repo = self.pool['runbot.repo'].browse(cr, uid, target_repo_id, context=context)
+
+        target_repo_ids = [target_repo.id]
+        r = target_repo.duplicate_id
+        while r:
+            if r.id in target_repo_ids:
+                break
+            target_repo_ids.append(r.id)
+            r = r.duplicate_id
+        return target_repo_ids
 
     def _get_closest_branch_name(self, cr, uid, ids, target_repo_id, context=None):
+        """Same as _find_closest_branch_name, memoized in runbot.closest.branch.
+
+        A resolution is reused as long as the build's sha is the same and no
+        branch of the target repos or of the build repo was added, removed or
+        written since (their count and last write date), which covers the
+        branches and PR heads names the rules look at and the heads used by
+        the merge-base rule. The open state of a matched PR is not checked
+        again.
+        """
+        assert len(ids) == 1
+        build = self.browse(cr, uid, ids[0], context=context)
+        target_repo_ids = self._get_target_repo_ids(cr, uid, target_repo_id, context=context)
+        cr.execute("""
+            SELECT string_agg(concat_ws(':', repo_id, n, w), ',' ORDER BY repo_id)
+              FROM (SELECT repo_id, count(*) AS n, max(write_date) AS w
+                      FROM runbot_branch
+                     WHERE repo_id IN %s
+                  GROUP BY repo_id) r
+        """, [tuple(set(target_repo_ids + [build.repo_id.id]))])
+        snapshot = cr.fetchone()[0]
+
+        Closest = self.pool['runbot.closest.branch']
+        domain = [('branch_id', '=', build.branch_id.id), ('sha', '=', build.name), ('target_repo_id', '=', target_repo_id)]
+        cached = Closest.search_read(cr, uid, domain, ['snapshot', 'result_repo_id', 'result_name', 'match'], context=context)
+        if cached and cached[0]['snapshot'] == snapshot:
+            return cached[0]['result_repo_id'][0], cached[0]['result_name'], cached[0]['match']
+
+        result = build._find_closest_branch_name(target_repo_id)
+        Closest._store(cr, uid, build.branch_id.id, build.name, target_repo_id, snapshot, result, context=context)
+        return result
+
+    def _find_closest_branch_name(self, cr, uid, ids, target_repo_id, context=None):
         """Return (repo, branch name) of the closest common branch between build's branch and
            any branch of target_repo or its duplicated repos.
 
@@ -711,15 +1810,7 @@ class runbot_build(osv.osv):
         pi = branch._get_pull_info()
         name = pi['base']['ref'] if pi else branch.branch_name
 
-        target_repo = self.pool['runbot.repo'].browse(cr, uid, target_repo_id, context=context)
-
-        target_repo_ids = [target_repo.id]
-        r = target_repo.duplicate_id
-        while r:
-            if r.id in target_repo_ids:
-                break
-            target_repo_ids.append(r.id)
-            r = r.duplicate_id
+        target_repo_ids = self._get_target_repo_ids(cr, uid, target_repo_id, context=context)
 
         _logger.debug('Search closest of %s (%s) in repos %r', name, repo.name, target_repo_ids)
 
@@ -914,11 +2005,37 @@ class runbot_build(osv.osv):
         paths = [os.path.join(datadir, pn, 'filestore', dbname) for pn in 'OpenERP Odoo'.split()]
         run(['rm', '-rf'] + paths)
 
-    def _local_pg_createdb(self, cr, uid, dbname):
+    def _local_pg_createdb(self, cr, uid, dbname, template='template0'):
         self._local_pg_dropdb(cr, uid, dbname)
         _logger.debug("createdb %s", dbname)
         with local_pgadmin_cursor() as local_cr:
-            local_cr.execute("""CREATE DATABASE "%s" TEMPLATE template0 LC_COLLATE 'C' ENCODING 'unicode'""" % dbname)
+            local_cr.execute("""CREATE DATABASE "%s" TEMPLATE "%s" LC_COLLATE 'C' ENCODING 'unicode'""" % (dbname, template))
+
+    def _base_template(self, cr, uid, build):
+        """Whether test_base also installs base without running its tests in
+        a template database for test_all, see _local_pg_createdb_from_base"""
+        return not build.branch_id.coverage and grep(build._server('tools/config.py'), 'data-dir')
+
+    def _local_pg_createdb_from_base(self, cr, uid, build, dbname):
+        """Create dbname as a copy of the database where test_base installed
+        base before any test ran, return False if that database cannot be
+        used"""
+        base_dbname = '%s-base-template' % build.dest
+        log_base = build._path('logs', 'job_10_base_template.txt')
+        if not self._base_template(cr, uid, build):
+            return False
+        if not grep(log_base, ".modules.loading: Modules loaded.") or rfind(log_base, _re_error):
+            return False
+        try:
+            self._local_pg_createdb(cr, uid, dbname, template=base_dbname)
+        except psycopg2.Error:
+            _logger.exception('%s cannot copy database %s', build.dest, base_dbname)
+            return False
+        filestore = build._path('datadir', 'filestore', base_dbname)
+        if os.path.isdir(filestore):
+            link_tree(filestore, build._path('datadir', 'filestore', dbname))
+        build._log('test_all', 'Database created from %s' % base_dbname)
+        return True
 
     def _cmd(self, cr, uid, ids, context=None):
         """Return a list describing the command to start the build"""
@@ -939,19 +2056,21 @@ class runbot_build(osv.osv):
                 "--xmlrpc-port=%d" % build.port,
             ]
             # options
-            if grep(build._server("tools/config.py"), "no-xmlrpcs"):
+            config_py = build._server("tools/config.py")
+            config_py = open(config_py).read() if os.path.isfile(config_py) else ''
+            if "no-xmlrpcs" in config_py:
                 cmd.append("--no-xmlrpcs")
-            if grep(build._server("tools/config.py"), "no-netrpc"):
+            if "no-netrpc" in config_py:
                 cmd.append("--no-netrpc")
-            if grep(build._server("tools/config.py"), "log-db"):
+            if "log-db" in config_py:
                 logdb = cr.dbname
                 if config['db_host'] and grep(build._server('sql_db.py'), 'allow_uri'):
                     logdb = 'postgres://{cfg[db_user]}:{cfg[db_password]}@{cfg[db_host]}/{db}'.format(cfg=config, db=cr.dbname)
                 cmd += ["--log-db=%s" % logdb]
-                if grep(build._server('tools/config.py'), 'log-db-level'):
+                if 'log-db-level' in config_py:
                     cmd += ["--log-db-level", '25']
 
-            if grep(build._server("tools/config.py"), "data-dir"):
+            if "data-dir" in config_py:
                 datadir = build._path('datadir')
                 if not os.path.exists(datadir):
                     os.mkdir(datadir)
@@ -959,8 +2078,28 @@ class runbot_build(osv.osv):
 
         return cmd, build.modules
 
-    def _spawn(self, cmd, lock_path, log_path, cpu_limit=None, shell=False, env=None):
+    def _cgroup(self, cr, uid, ids, job=None, create=False, context=None):
+        """Return the cgroup of the current job (or job) of the build, None
+        if runbot.cgroup, the cgroup v2 under which jobs run, is not set"""
+        icp = self.pool['ir.config_parameter']
+        root = icp.get_param(cr, uid, 'runbot.cgroup')
+        if not root:
+            return None
+        build = self.browse(cr, uid, ids[0], context=context)
+        path = os.path.join(root, '%s-%s' % (build.dest, job or build.job))
+        if create:
+            cgroup_create(
+                path,
+                cpu_weight=int(icp.get_param(cr, uid, 'runbot.cgroup_cpu_weight', default=100)),
+                memory_max=int(icp.get_param(cr, uid, 'runbot.cgroup_memory_max', default=0)),
+                io_weight=int(icp.get_param(cr, uid, 'runbot.cgroup_io_weight', default=100)),
+            )
+        return path
+
+    def _spawn(self, cmd, lock_path, log_path, cpu_limit=None, shell=False, env=None, cgroup=None):
         def preexec_fn():
+            if cgroup:
+                cgroup_write(cgroup, 'cgroup.procs', os.getpid())
             os.setsid()
             if cpu_limit:
                 # set soft cpulimit
@@ -974,6 +2113,7 @@ class runbot_build(osv.osv):
         out = open(log_path, "w")
         _logger.debug("spawn: %s stdout: %s", ' '.join(cmd), log_path)
         p = subprocess.Popen(cmd, stdout=out, stderr=out, preexec_fn=preexec_fn, shell=shell, env=env)
+        _spawned[p.pid] = p
         return p.pid
 
     def _github_status(self, cr, uid, ids, context=None):
@@ -999,7 +2139,7 @@ class runbot_build(osv.osv):
                 "context": "ci/runbot"
             }
             _logger.debug("github updating status %s to %s", build.name, state)
-            build.repo_id._github('/repos/:owner/:repo/statuses/%s' % build.name, status, ignore_errors=True)
+            build.repo_id._github_queue_status(build.name, status)
 
     def _job_00_init(self, cr, uid, build, lock_path, log_path):
         build._log('init', 'Init build environment')
@@ -1016,11 +2156,92 @@ class runbot_build(osv.osv):
         if grep(build._server("tools/config.py"), "test-enable"):
             cmd.append("--test-enable")
         cmd += ['-d', '%s-base' % build.dest, '-i', 'base', '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
-        return self._spawn(cmd, lock_path, log_path, cpu_limit=300)
+        if not self._base_template(cr, uid, build):
+            return self._spawn(cmd, lock_path, log_path, cpu_limit=300, cgroup=build._cgroup(create=True))
+        # meanwhile, install base without tests in the template of test_all
+        # so that nothing the tests commit leaks into it
+        template_dbname = '%s-base-template' % build.dest
+        self._local_pg_createdb(cr, uid, template_dbname)
+        port = self.pool['runbot.port']._assign(cr, uid, fqdn(), build.id, context=None)
+        template_cmd, mods = build._cmd()
+        template_cmd = [("--xmlrpc-port=%d" % port) if arg.startswith("--xmlrpc-port=") else arg for arg in template_cmd]
+        template_cmd += ['-d', template_dbname, '-i', 'base', '--stop-after-init', '--max-cron-threads=0']
+        script = [
+            '%s > %s 2>&1 &' % (' '.join(map(pipes.quote, template_cmd)),
+                                pipes.quote(build._path('logs', 'job_10_base_template.txt'))),
+            ' '.join(map(pipes.quote, cmd)),
+            'status=$?',
+            'wait',
+            'exit $status',
+        ]
+        return self._spawn(['\n'.join(script)], lock_path, log_path, cpu_limit=300, shell=True, cgroup=build._cgroup(create=True))
+
+    def _module_depends(self, cr, uid, build, context=None):
+        """Return the dependencies of the modules available in build"""
+        depends = {}
+        for manifest in (glob.glob(build._server('addons/*/__openerp__.py')) +
+                         glob.glob(build._server('addons/*/__manifest__.py'))):
+            module = os.path.basename(os.path.dirname(manifest))
+            try:
+                with open(manifest) as f:
+                    depends[module] = ast.literal_eval(f.read()).get('depends', [])
+            except Exception:
+                depends[module] = []
+        return depends
+
+    def _module_weights(self, cr, uid, build, context=None):
+        """Return the average duration of the modules in the last builds of
+        the repo of build having timings"""
+        cr.execute("""
+            SELECT t.module, sum(t.duration) / count(DISTINCT t.build_id)
+              FROM runbot_build_timing t
+             WHERE t.build_id IN (SELECT b.id
+                                    FROM runbot_build b
+                                   WHERE b.repo_id = %s
+                                     AND EXISTS (SELECT 1 FROM runbot_build_timing bt WHERE bt.build_id = b.id)
+                                ORDER BY b.id DESC
+                                   LIMIT 5)
+          GROUP BY t.module
+        """, [build.repo_id.id])
+        return dict(cr.fetchall())
+
+    def _shard_modules(self, cr, uid, build, modules, count, context=None):
+        """Split modules into at most count lists of modules to install.
+
+        Installing a module installs and tests its dependencies as well, so
+        the load of a shard is the weight of the closure of its modules; each
+        module goes, heaviest first, to the shard it makes the lightest.
+        """
+        depends = self._module_depends(cr, uid, build, context=context)
+        weights = self._module_weights(cr, uid, build, context=context)
+        default_weight = sum(weights.values()) / len(weights) if weights else 1.0
+        closures = {'base': set()}
+
+        def closure(module):
+            if module not in closures:
+                closures[module] = set([module])
+                for dep in depends.get(module, []):
+                    closures[module] |= closure(dep) | set([dep])
+            return closures[module]
+
+        def weight(mods):
+            return sum(weights.get(m, default_weight) for m in mods if m != 'base')
+
+        shards = [set() for i in range(count)]
+        shard_modules = [[] for i in range(count)]
+        for module in sorted(modules, key=lambda m: weight(closure(m)), reverse=True):
+            i = min(range(count), key=lambda i: weight(shards[i] | closure(module)))
+            shards[i] |= closure(module)
+            shard_modules[i].append(module)
+        return filter(None, shard_modules)
 
     def _job_20_test_all(self, cr, uid, build, lock_path, log_path):
         build._log('test_all', 'Start test all modules')
-        self._local_pg_createdb(cr, uid, "%s-all" % build.dest)
+        if build.branch_id.test_shards > 1 and not build.branch_id.coverage:
+            return self._job_20_test_all_sharded(cr, uid, build, lock_path, log_path)
+        # base is already installed (and tested) by test_base
+        if not self._local_pg_createdb_from_base(cr, uid, build, "%s-all" % build.dest):
+            self._local_pg_createdb(cr, uid, "%s-all" % build.dest)
         cmd, mods = build._cmd()
         if grep(build._server("tools/config.py"), "test-enable"):
             cmd.append("--test-enable")
@@ -1037,8 +2258,89 @@ class runbot_build(osv.osv):
             omit = ['--omit', ','.join(build._server('addons', m) for m in bad_modules)] if bad_modules else []
             cmd = ['coverage', 'run', '--branch', '--source', build._server()] + omit + cmd[:]
         # reset job_start to an accurate job_20 job_time
-        build.write({'job_start': now()})
-        return self._spawn(cmd, lock_path, log_path, cpu_limit=2100, env=env)
+        build.write({
+            'job_start': now(),
+            'log_offset': 0,
+            'log_errors': 0,
+            'log_warnings': 0,
+            'log_loaded': False,
+            'log_shutdown': False,
+        })
+        return self._spawn(cmd, lock_path, log_path, cpu_limit=2100, env=env, cgroup=build._cgroup(create=True))
+
+    def _job_20_test_all_sharded(self, cr, uid, build, lock_path, log_path):
+        """Install and test the modules of build with test_shards servers in
+        parallel. Each shard logs to its own file, scanned by _analyze_log,
+        and keeps its exit status next to it, see _shards_failed. Once all of
+        them are done, the modules missing from the database of the first
+        shard, which is the one of the running build, are installed without
+        tests and the logs are appended to log_path."""
+        cmd, mods = build._cmd()
+        shards = self._shard_modules(cr, uid, build, filter(None, (mods or '').split(',')),
+                                     build.branch_id.test_shards)
+        build._log('test_all', 'Testing modules in %s shards' % len(shards))
+        test_enable = grep(build._server("tools/config.py"), "test-enable")
+        Port = self.pool['runbot.port']
+        script = []
+        shard_logs = []
+        for i, shard_mods in enumerate(shards):
+            dbname = "%s-all" % build.dest if i == 0 else "%s-all-%s" % (build.dest, i)
+            if not self._local_pg_createdb_from_base(cr, uid, build, dbname):
+                self._local_pg_createdb(cr, uid, dbname)
+            port = build.port if i == 0 else Port._assign(cr, uid, fqdn(), build.id, context=None)
+            shard_cmd = [("--xmlrpc-port=%d" % port) if arg.startswith("--xmlrpc-port=") else arg for arg in cmd]
+            if test_enable:
+                shard_cmd.append("--test-enable")
+            shard_cmd += ['-d', dbname, '-i', openerp.tools.ustr(','.join(shard_mods)), '--stop-after-init', '--log-level=test', '--max-cron-threads=0']
+            shard_log = build._path('logs', 'job_20_test_all-%s.txt' % i)
+            shard_logs.append(shard_log)
+            shard_status = build._path('logs', 'job_20_test_all-%s.status' % i)
+            script.append('(%s > %s 2>&1; echo $? > %s) &' % (' '.join(map(pipes.quote, shard_cmd)),
+                                                              pipes.quote(shard_log), pipes.quote(shard_status)))
+        script.append('wait')
+        install_cmd = cmd + ['-d', "%s-all" % build.dest, '-i', openerp.tools.ustr(','.join(itertools.chain(*shards))),
+                             '--stop-after-init', '--max-cron-threads=0']
+        install_log = build._path('logs', 'job_20_test_all-install.txt')
+        script.append('%s > %s 2>&1; echo $? > %s' % (' '.join(map(pipes.quote, install_cmd)), pipes.quote(install_log),
+                                                      pipes.quote(build._path('logs', 'job_20_test_all-install.status'))))
+        script.append('cat %s' % ' '.join(map(pipes.quote, shard_logs + [install_log])))
+        # reset job_start to an accurate job_20 job_time
+        build.write({
+            'job_start': now(),
+            'log_offset': 0,
+            'log_shard_offsets': False,
+            'log_errors': 0,
+            'log_warnings': 0,
+            'log_loaded': False,
+            'log_shutdown': False,
+        })
+        return self._spawn(['\n'.join(script)], lock_path, log_path, cpu_limit=2100, shell=True, cgroup=build._cgroup(create=True))
+
+    def _shard_logs(self, cr, uid, build):
+        """Return the logs of the test_all shards of build, by shard"""
+        shard_logs = glob.glob(build._path('logs', 'job_20_test_all-[0-9]*.txt'))
+        return sorted(shard_logs, key=lambda path: int(path.rsplit('-', 1)[1][:-len('.txt')]))
+
+    def _shards_failed(self, cr, uid, build, post_install):
+        """Return the parts of a sharded test_all of build which failed: the
+        indexes of the shards which exited with an error or whose log lacks
+        the loading or shutdown markers, and 'install' if the final install
+        of all modules exited with an error"""
+        shard_logs = self._shard_logs(cr, uid, build)
+        failed = []
+        for i, shard_log in enumerate(shard_logs):
+            if self._shard_status(cr, uid, build, i) != '0' or not grep(shard_log, ".modules.loading: Modules loaded.") or \
+                    (post_install and not grep(shard_log, "Initiating shutdown.")):
+                failed.append(str(i))
+        if shard_logs and self._shard_status(cr, uid, build, 'install') != '0':
+            failed.append('install')
+        return failed
+
+    def _shard_status(self, cr, uid, build, part):
+        """Return the exit status of a part of a sharded test_all of build,
+        None if it did not exit"""
+        status_path = build._path('logs', 'job_20_test_all-%s.status' % part)
+        return open(status_path).read().strip() if os.path.isfile(status_path) else None
 
     def _coverage_env(self, build):
         return dict(os.environ, COVERAGE_FILE=build._path('.coverage'))
@@ -1049,7 +2351,57 @@ class runbot_build(osv.osv):
         cov_path = build._path('coverage')
         mkdirs([cov_path])
         cmd = ["coverage", "html", "-d", cov_path, "--ignore-errors"]
-        return self._spawn(cmd, lock_path, log_path, env=self._coverage_env(build))
+        return self._spawn(cmd, lock_path, log_path, env=self._coverage_env(build), cgroup=build._cgroup(create=True))
+
+    def _analyze_log(self, cr, uid, ids, final=False, context=None):
+        """Scan the test_all log lines written since the previous call and
+        update the error and warning counters of the builds.
+
+        The logs of the shards of a sharded test_all are scanned instead of
+        the test_all log, which only gets them once all shards are done.
+        """
+        markers = (".modules.loading: Modules loaded.", "Initiating shutdown.")
+        for build in self.browse(cr, uid, ids, context=context):
+            logs = self._shard_logs(cr, uid, build)
+            sharded = bool(logs)
+            if sharded:
+                offsets = [int(o) for o in (build.log_shard_offsets or '').split(',') if o]
+                offsets += [0] * (len(logs) - len(offsets))
+            else:
+                log_all = build._path('logs', 'job_20_test_all.txt')
+                if not os.path.isfile(log_all):
+                    continue
+                logs, offsets = [log_all], [build.log_offset]
+            previous_offsets = list(offsets)
+            if any(os.path.getsize(path) < offset for path, offset in zip(logs, offsets)):
+                # log was truncated, start over
+                offsets = [0] * len(logs)
+                build.write({'log_errors': 0, 'log_warnings': 0, 'log_loaded': False, 'log_shutdown': False})
+                build.refresh()
+            if not any(offsets):
+                cr.execute("DELETE FROM runbot_build_timing WHERE build_id = %s", [build.id])
+            new_offsets, errors, warnings, found, timings = [], 0, 0, set(), []
+            for path, offset in zip(logs, offsets):
+                new_offset, log_errors, log_warnings, log_found, log_timings = scan_log(path, offset, markers, final=final)
+                new_offsets.append(new_offset)
+                errors += log_errors
+                warnings += log_warnings
+                found |= log_found
+                timings += log_timings
+            if new_offsets == previous_offsets:
+                continue
+            self.pool['runbot.build.timing']._record(cr, uid, build, timings, context=context)
+            v = {
+                'log_errors': build.log_errors + errors,
+                'log_warnings': build.log_warnings + warnings,
+                'log_loaded': build.log_loaded or markers[0] in found,
+                'log_shutdown': build.log_shutdown or markers[1] in found,
+            }
+            if sharded:
+                v['log_shard_offsets'] = ','.join(map(str, new_offsets))
+            else:
+                v['log_offset'] = new_offsets[0]
+            build.write(v)
 
     def _job_30_run(self, cr, uid, build, lock_path, log_path):
         # adjust job_end to record an accurate job_20 job_time
@@ -1059,12 +2411,22 @@ class runbot_build(osv.osv):
         v = {
             'job_end': time.strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT, log_time),
         }
-        if grep(log_all, ".modules.loading: Modules loaded."):
-            if rfind(log_all, _re_error):
+        # the extra ports of the base template and test_all shards are no longer used
+        self.pool['runbot.port']._release(cr, uid, [build.id], keep_build_port=True)
+        # consume the tail of the log, the rest was scanned while testing
+        build._analyze_log(final=True)
+        build.refresh()
+        post_install = grep(build._server("test/common.py"), "post_install")
+        failed_shards = self._shards_failed(cr, uid, build, post_install)
+        if failed_shards:
+            build._log('run', 'Sharded test_all parts %s failed' % ', '.join(failed_shards))
+            v['result'] = "ko"
+        elif build.log_loaded:
+            if build.log_errors:
                 v['result'] = "ko"
-            elif rfind(log_all, _re_warning):
+            elif build.log_warnings:
                 v['result'] = "warn"
-            elif not grep(build._server("test/common.py"), "post_install") or grep(log_all, "Initiating shutdown."):
+            elif not post_install or build.log_shutdown:
                 v['result'] = "ok"
         else:
             v['result'] = "ko"
@@ -1101,7 +2463,7 @@ class runbot_build(osv.osv):
         #    f.close()
         #cmd=[self.client_web_bin_path]
 
-        return self._spawn(cmd, lock_path, log_path, cpu_limit=None)
+        return self._spawn(cmd, lock_path, log_path, cpu_limit=None, cgroup=build._cgroup(create=True))
 
     def _force(self, cr, uid, ids, context=None):
         """Force a rebuild"""
@@ -1153,7 +2515,7 @@ class runbot_build(osv.osv):
                 continue
             elif build.state == 'pending':
                 # allocate port and schedule first job
-                port = self._find_port(cr, uid)
+                port = self._find_port(cr, uid, build.id, fqdn())
                 values = {
                     'host': fqdn(),
                     'port': port,
@@ -1167,6 +2529,8 @@ class runbot_build(osv.osv):
                 # check if current job is finished
                 lock_path = build._path('logs', '%s.lock' % build.job)
                 if locked(lock_path):
+                    if build.job == 'job_20_test_all':
+                        build._analyze_log()
                     # kill if overpassed
                     timeout = (build.branch_id.job_timeout or default_timeout) * 60
                     if build.job != jobs[-1] and build.job_time > timeout:
@@ -1191,7 +2555,97 @@ class runbot_build(osv.osv):
                     v['job'] = jobs[jobs.index(build.job) + 1]
                 build.write(v)
             build.refresh()
-
+            build._run_job()
+
+    def _claim(self, cr, uid, repo_ids, host, limit, context=None):
+        """Atomically move up to limit pending builds of repo_ids to testing on
+        host and return their ids, highest _pending_priority first; builds
+        being claimed by other hosts are skipped."""
+        if not repo_ids or limit <= 0:
+            return []
+        priority, params = self._pending_priority(cr, uid, context=context)
+        params.update({'host': host, 'job': self._list_jobs()[0], 'now': now(), 'uid': uid,
+                       'repo_ids': tuple(repo_ids), 'limit': limit})
+        # start from a fresh snapshot to avoid serialization failures on the claimed rows
+        cr.commit()
+        try:
+            cr.execute("""
+                WITH pending AS (
+                    SELECT b.id, b.repo_id, b.author_email, b.create_date,
+                           br.sticky IS TRUE AS sticky,
+                           CASE WHEN br.sticky THEN -b.id ELSE b.sequence END AS rank,
+                           row_number() OVER (PARTITION BY b.repo_id ORDER BY b.sequence) - 1 AS repo_rank,
+                           row_number() OVER (PARTITION BY b.author_email ORDER BY b.sequence) - 1 AS author_rank
+                      FROM runbot_build b
+                      JOIN runbot_branch br ON (br.id = b.branch_id)
+                     WHERE b.repo_id IN %%(repo_ids)s
+                       AND b.state = 'pending'
+                ), repo_load AS (
+                    SELECT repo_id, count(*) AS testing
+                      FROM runbot_build
+                     WHERE state = 'testing'
+                  GROUP BY repo_id
+                ), author_load AS (
+                    SELECT author_email, count(*) AS testing
+                      FROM runbot_build
+                     WHERE state = 'testing'
+                  GROUP BY author_email
+                )
+                UPDATE runbot_build
+                   SET state = 'testing', host = %%(host)s, job = %%(job)s,
+                       job_start = %%(now)s, job_end = NULL,
+                       write_uid = %%(uid)s, write_date = now() at time zone 'UTC'
+                 WHERE id IN (
+                        SELECT b.id
+                          FROM runbot_build b
+                          JOIN pending p ON (p.id = b.id)
+                     LEFT JOIN repo_load rl ON (rl.repo_id = p.repo_id)
+                     LEFT JOIN author_load al ON (al.author_email = p.author_email)
+                         WHERE b.state = 'pending'
+                      ORDER BY %s DESC, p.rank
+                         LIMIT %%(limit)s
+                           FOR UPDATE OF b SKIP LOCKED
+                       )
+             RETURNING id
+            """ % priority, params)
+        except psycopg2.extensions.TransactionRollbackError:
+            _logger.info('concurrent claim of pending builds, retrying at next cron')
+            cr.rollback()
+            return []
+        ids = [r[0] for r in cr.fetchall()]
+        self.invalidate_cache(cr, uid, ['state', 'host', 'job', 'job_start', 'job_end'], ids, context=context)
+        for build_id in ids:
+            self.write(cr, uid, [build_id], {'port': self._find_port(cr, uid, build_id, host)}, context=context)
+        cr.commit()
+        return ids
+
+    def _pending_priority(self, cr, uid, context=None):
+        """Return the SQL expression ranking pending builds for _claim (highest
+        first) and its parameters.
+
+        The expression can use the pending build ``p`` (sticky, create_date,
+        repo_rank and author_rank, the number of pending builds of the same
+        repo/author before it) and the number of builds in testing of its repo
+        ``rl.testing`` and author ``al.testing``.
+        """
+        icp = self.pool['ir.config_parameter']
+        params = {
+            'sticky_boost': float(icp.get_param(cr, uid, 'runbot.sched_sticky_boost', default=1000)),
+            'aging': float(icp.get_param(cr, uid, 'runbot.sched_aging', default=0)),
+            'repo_share': float(icp.get_param(cr, uid, 'runbot.sched_repo_share', default=0)),
+            'author_share': float(icp.get_param(cr, uid, 'runbot.sched_author_share', default=0)),
+        }
+        priority = """(
+            CASE WHEN p.sticky THEN %(sticky_boost)s ELSE 0 END
+            + %(aging)s * EXTRACT(EPOCH FROM (now() at time zone 'UTC') - p.create_date) / 60
+            - %(repo_share)s * (p.repo_rank + COALESCE(rl.testing, 0))
+            - %(author_share)s * (p.author_rank + COALESCE(al.testing, 0))
+        )"""
+        return priority, params
+
+    def _run_job(self, cr, uid, ids, context=None):
+        """Start the current job of the builds"""
+        for build in self.browse(cr, uid, ids, context=context):
             # run job
             pid = None
             if build.state != 'done':
@@ -1203,6 +2657,8 @@ class runbot_build(osv.osv):
                 try:
                     pid = job_method(cr, uid, build, lock_path, log_path)
                     build.write({'pid': pid})
+                    if pid > 0:
+                        self.pool['runbot.build.usage']._start(cr, uid, build, pid, context=context)
                 except Exception:
                     _logger.exception('%s failed running method %s', build.dest, build.job)
                     build._log(build.job, "failed running job method, see runbot log")
@@ -1257,6 +2713,35 @@ class runbot_build(osv.osv):
             if b not in actives and os.path.isdir(path):
                 shutil.rmtree(path)
         
+        # cleanup: trees of the checkout cache not used for 7 days
+        limit = time.time() - 7 * 24 * 3600
+        for path in glob.glob(os.path.join(root, 'tree', '*', '*')):
+            if os.path.getmtime(path) < limit:
+                shutil.rmtree(path, ignore_errors=True)
+
+        # cleanup: cgroups of the jobs which are neither running nor waiting
+        # to be reaped, left when their processes were still exiting
+        cgroup_root = self.pool['ir.config_parameter'].get_param(cr, uid, 'runbot.cgroup')
+        if cgroup_root:
+            host = fqdn()
+            cr.execute("""
+                SELECT concat(dest, '-', job)
+                  FROM runbot_build
+                 WHERE host = %s
+                   AND state IN ('testing', 'running')
+                   AND job IS NOT NULL
+             UNION ALL
+                SELECT concat(b.dest, '-', u.job)
+                  FROM runbot_build_usage u
+                  JOIN runbot_build b ON (b.id = u.build_id)
+                 WHERE u.host = %s
+                   AND NOT coalesce(u.done, false)
+            """, [host, host])
+            actives = set(r[0] for r in cr.fetchall())
+            for path in glob.glob(os.path.join(cgroup_root, '*-job_*')):
+                if os.path.basename(path) not in actives:
+                    cgroup_remove(path)
+
         # cleanup old unused databases
         cr.execute("select id from runbot_build where state in ('testing', 'running')")
         db_ids = [id[0] for id in cr.fetchall()]
@@ -1286,6 +2771,10 @@ class runbot_build(osv.osv):
                     os.killpg(build.pid, signal.SIGKILL)
                 except OSError:
                     pass
+            cgroup = build.job and build._cgroup()
+            if cgroup:
+                # also kills the processes which left the process group
+                cgroup_kill(cgroup)
             v = {'state': 'done', 'job': False}
             if result:
                 v['result'] = result
@@ -1305,6 +2794,7 @@ class runbot_build(osv.osv):
                 build._log('_ask_kill', 'Killing build %s, requested by %s (user #%s)' % (build.dest, user.name, uid))
 
     def _reap(self, cr, uid, ids):
+        reaped = []
         while True:
             try:
                 pid, status, rusage = os.wait3(os.WNOHANG)
@@ -1313,6 +2803,12 @@ class runbot_build(osv.osv):
             if pid == 0:
                 break
             _logger.debug('reaping: pid: %s status: %s', pid, status)
+            reaped.append((pid, status, rusage))
+            p = _spawned.pop(pid, None)
+            if p:
+                p.returncode = status
+        if reaped:
+            self.pool['runbot.build.usage']._record(cr, uid, fqdn(), reaped)
 
     def _log(self, cr, uid, ids, func, message, context=None):
         assert len(ids) == 1
@@ -1328,6 +2824,160 @@ class runbot_build(osv.osv):
             'line': '0',
         }, context=context)
 
+class runbot_build_usage(osv.osv):
+    _name = "runbot.build.usage"
+    _order = 'id desc'
+
+    _columns = {
+        'build_id': fields.many2one('runbot.build', 'Build', required=True, ondelete='cascade', select=1),
+        'branch_id': fields.many2one('runbot.branch', 'Branch', ondelete='cascade', select=1),
+        'repo_id': fields.many2one('runbot.repo', 'Repository', ondelete='cascade'),
+        'job': fields.char('Job'),
+        'host': fields.char('Host'),
+        'pid': fields.integer('Pid'),
+        'done': fields.boolean('Done'),
+        'exit_status': fields.integer('Exit status'),
+        'cpu_time': fields.float('CPU time (s)', group_operator='avg'),
+        'cpu_user': fields.float('User CPU time (s)', group_operator='avg'),
+        'cpu_system': fields.float('System CPU time (s)', group_operator='avg'),
+        'max_rss': fields.integer('Max RSS (KiB)', group_operator='max'),
+        'read_blocks': fields.integer('Blocks read', group_operator='avg'),
+        'write_blocks': fields.integer('Blocks written', group_operator='avg'),
+    }
+
+    def _start(self, cr, uid, build, pid, context=None):
+        """Register the process pid running the current job of build"""
+        return self.create(cr, uid, {
+            'build_id': build.id,
+            'branch_id': build.branch_id.id,
+            'repo_id': build.repo_id.id,
+            'job': build.job,
+            'host': fqdn(),
+            'pid': pid,
+        }, context=context)
+
+    def _record(self, cr, uid, host, reaped, context=None):
+        """Store the resource usage of the job processes reaped on host, a
+        list of (pid, status, rusage) as returned by os.wait3.
+
+        When jobs run in cgroups, the counters of the cgroup, which include
+        every process of the job, replace the rusage and the cgroup is
+        removed."""
+        Build = self.pool['runbot.build']
+        for pid, status, rusage in reaped:
+            cr.execute("""
+                UPDATE runbot_build_usage
+                   SET done = true,
+                       exit_status = %s,
+                       cpu_time = %s,
+                       cpu_user = %s,
+                       cpu_system = %s,
+                       max_rss = %s,
+                       read_blocks = %s,
+                       write_blocks = %s
+                 WHERE id = (SELECT max(id)
+                               FROM runbot_build_usage
+                              WHERE host = %s
+                                AND pid = %s
+                                AND NOT coalesce(done, false))
+             RETURNING id, build_id, job
+            """, [os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+                  rusage.ru_utime + rusage.ru_stime, rusage.ru_utime, rusage.ru_stime,
+                  rusage.ru_maxrss, rusage.ru_inblock, rusage.ru_oublock,
+                  host, pid])
+            row = cr.fetchone()
+            if not row:
+                continue
+            usage_id, build_id, job = row
+            cgroup = Build._cgroup(cr, uid, [build_id], job=job, context=context)
+            if not cgroup or not os.path.isdir(cgroup):
+                continue
+            try:
+                cpu_user, cpu_system, max_rss, read_blocks, write_blocks = cgroup_stats(cgroup)
+            except (IOError, OSError, ValueError):
+                _logger.warning('cgroup %s: could not read statistics', cgroup)
+            else:
+                cr.execute("""
+                    UPDATE runbot_build_usage
+                       SET cpu_time = %s, cpu_user = %s, cpu_system = %s,
+                           max_rss = coalesce(%s, max_rss), read_blocks = %s, write_blocks = %s
+                     WHERE id = %s
+                """, [cpu_user + cpu_system, cpu_user, cpu_system,
+                      max_rss, read_blocks, write_blocks, usage_id])
+            cgroup_remove(cgroup)
+
+class runbot_build_timing(osv.osv):
+    _name = "runbot.build.timing"
+    _order = 'build_id desc, duration desc'
+    _log_access = False
+
+    _columns = {
+        'build_id': fields.many2one('runbot.build', 'Build', required=True, ondelete='cascade', select=1),
+        'branch_id': fields.many2one('runbot.branch', 'Branch', ondelete='cascade', select=1),
+        'module': fields.char('Module', required=True),
+        'test': fields.char('Test', help="Test file, empty for the install of the module"),
+        'tests': fields.integer('Tests'),
+        'duration': fields.float('Duration (s)'),
+    }
+
+    def _record(self, cr, uid, build, timings, context=None):
+        """Store timings as returned by scan_log for build"""
+        if not timings:
+            return
+        modules, tests, counts, durations = zip(*timings)
+        cr.execute("""
+            INSERT INTO runbot_build_timing (build_id, branch_id, module, test, tests, duration)
+                 SELECT %s, %s, unnest(%s::varchar[]), unnest(%s::varchar[]),
+                        unnest(%s::int[]), unnest(%s::float[])
+        """, [build.id, build.branch_id.id, list(modules), [t or None for t in tests],
+              list(counts), list(durations)])
+
+    def _trend(self, cr, uid, branch_id, context=None):
+        """Compare the module timings of the last build of branch_id with their
+        average over the previous ones (runbot.timing_baseline builds).
+
+        Return a list of dicts (module, kind, duration, baseline, change in
+        percent and regressed, true when change exceeds
+        runbot.timing_regression percent), biggest change first.
+        """
+        icp = self.pool['ir.config_parameter']
+        baseline = int(icp.get_param(cr, uid, 'runbot.timing_baseline', default=10))
+        threshold = float(icp.get_param(cr, uid, 'runbot.timing_regression', default=20))
+        cr.execute("""
+            WITH builds AS (
+                SELECT b.id, row_number() OVER (ORDER BY b.sequence DESC) AS rank
+                  FROM runbot_build b
+                 WHERE b.branch_id = %s
+                   AND b.state IN ('running', 'done')
+                   AND EXISTS (SELECT 1 FROM runbot_build_timing t WHERE t.build_id = b.id)
+              ORDER BY b.sequence DESC
+                 LIMIT %s
+            ), modules AS (
+                SELECT b.rank, t.module, t.test IS NULL AS install, sum(t.duration) AS duration
+                  FROM runbot_build_timing t
+                  JOIN builds b ON b.id = t.build_id
+              GROUP BY b.rank, t.module, t.test IS NULL
+            )
+            SELECT cur.module, cur.install, cur.duration, avg(base.duration)
+              FROM modules cur
+              JOIN modules base ON (base.module = cur.module AND base.install = cur.install AND base.rank > 1)
+             WHERE cur.rank = 1
+          GROUP BY cur.module, cur.install, cur.duration
+        """, [branch_id, baseline + 1])
+        trend = []
+        for module, install, duration, average in cr.fetchall():
+            change = (duration - average) * 100 / average if average else 0
+            trend.append({
+                'module': module,
+                'kind': 'install' if install else 'tests',
+                'duration': duration,
+                'baseline': average,
+                'change': change,
+                'regressed': change > threshold,
+            })
+        trend.sort(key=lambda t: t['change'], reverse=True)
+        return trend
+
 class runbot_event(osv.osv):
     _inherit = 'ir.logging'
     _order = 'id'
@@ -1343,30 +2993,56 @@ class runbot_event(osv.osv):
         if hasattr(parent_class, 'init'):
             parent_class.init(cr)
 
+        # build_id is set on the inserted row itself, an AFTER INSERT
+        # trigger would write every log line twice
         cr.execute("""
 CREATE OR REPLACE FUNCTION runbot_set_logging_build() RETURNS TRIGGER AS $$
 BEGIN
   IF (new.build_id IS NULL AND new.dbname IS NOT NULL AND new.dbname != current_database()) THEN
-    UPDATE ir_logging l
-       SET build_id = split_part(new.dbname, '-', 1)::integer
-     WHERE l.id = new.id;
+    new.build_id := split_part(new.dbname, '-', 1)::integer;
   END IF;
-RETURN NULL;
+RETURN new;
 END;
 $$ language plpgsql;
 
-DO $$
-BEGIN
-    CREATE TRIGGER runbot_new_logging
-    AFTER INSERT ON ir_logging
-    FOR EACH ROW
-    EXECUTE PROCEDURE runbot_set_logging_build();
-EXCEPTION
-    WHEN duplicate_object THEN
-END;
-$$;
+DROP TRIGGER IF EXISTS runbot_new_logging ON ir_logging;
+CREATE TRIGGER runbot_new_logging
+BEFORE INSERT ON ir_logging
+FOR EACH ROW
+EXECUTE PROCEDURE runbot_set_logging_build();
+        """)
+        # warnings and errors of a build, see runbot_build._guess_result
+        cr.execute("""
+            CREATE INDEX IF NOT EXISTS runbot_logging_problem_index
+                ON ir_logging (build_id, level)
+             WHERE level IN ('WARNING', 'ERROR', 'CRITICAL')
         """)
 
+    def _cron_cleanup(self, cr, uid, limit=100, context=None):
+        """Delete the logs of the builds done for more than runbot.log_max_age
+        days, a batch of builds at a time, and the closest branch resolutions
+        of outdated shas"""
+        self.pool['runbot.closest.branch']._purge(cr, uid, context=context)
+        cr.commit()
+        icp = self.pool['ir.config_parameter']
+        max_age = int(icp.get_param(cr, uid, 'runbot.log_max_age', default=0))
+        if not max_age:
+            return
+        while True:
+            cr.execute("""
+                SELECT id
+                  FROM runbot_build b
+                 WHERE state = 'done'
+                   AND job_end < (now() at time zone 'UTC') - interval '1 day' * %s
+                   AND EXISTS (SELECT 1 FROM ir_logging l WHERE l.build_id = b.id)
+                 LIMIT %s
+            """, [max_age, limit])
+            build_ids = [r[0] for r in cr.fetchall()]
+            if not build_ids:
+                break
+            cr.execute("DELETE FROM ir_logging WHERE build_id IN %s", [tuple(build_ids)])
+            cr.commit()
+
 #----------------------------------------------------------
 # Runbot Controller
 #----------------------------------------------------------
@@ -1381,18 +3057,18 @@ class RunbotController(http.Controller):
         build_obj = registry['runbot.build']
         icp = registry['ir.config_parameter']
         repo_obj = registry['runbot.repo']
-        count = lambda dom: build_obj.search_count(cr, uid, dom)
 
         repo_ids = repo_obj.search(cr, uid, [])
         repos = repo_obj.browse(cr, uid, repo_ids)
         if not repo and repos:
             repo = repos[0] 
+        stats = build_obj._stats_info(cr, uid, repo_ids)
 
         context = {
             'repos': repos,
             'repo': repo,
-            'host_stats': [],
-            'pending_total': count([('state','=','pending')]),
+            'host_stats': stats['host_stats'],
+            'pending_total': stats['pending_total'],
             'limit': limit,
             'search': search,
             'refresh': refresh,
@@ -1457,33 +3133,34 @@ class RunbotController(http.Controller):
                     'builds': [self.build_info(build_dict[build_id]) for build_id in build_by_branch_ids[branch.id]]
                 }
 
+            context.update(stats['repos'].get(repo.id) or dict.fromkeys(['pending', 'testing', 'running'], 0))
             context.update({
                 'branches': [branch_info(b) for b in branches],
-                'testing': count([('repo_id','=',repo.id), ('state','=','testing')]),
-                'running': count([('repo_id','=',repo.id), ('state','=','running')]),
-                'pending': count([('repo_id','=',repo.id), ('state','=','pending')]),
                 'qu': QueryURL('/runbot/repo/'+slug(repo), search=search, limit=limit, refresh=refresh, **filters),
                 'filters': filters,
             })
 
-        # consider host gone if no build in last 100
-        build_threshold = max(build_ids or [0]) - 100
-
-        for result in build_obj.read_group(cr, uid, [('id', '>', build_threshold)], ['host'], ['host']):
-            if result['host']:
-                context['host_stats'].append({
-                    'host': result['host'],
-                    'testing': count([('state', '=', 'testing'), ('host', '=', result['host'])]),
-                    'running': count([('state', '=', 'running'), ('host', '=', result['host'])]),
-                })
-
         return request.render("runbot.repo", context)
 
     @http.route(['/runbot/hook/<int:repo_id>'], type='http', auth="public", website=True)
     def hook(self, repo_id=None, **post):
         # TODO if repo_id == None parse the json['repository']['ssh_url'] and find the right repo
         repo = request.registry['runbot.repo'].browse(request.cr, SUPERUSER_ID, [repo_id])
-        repo.hook_time = datetime.datetime.now().strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT)
+        if repo.hook_secret:
+            signature = 'sha1=' + hmac.new(repo.hook_secret.encode('utf-8'), request.httprequest.get_data(),
+                                           hashlib.sha1).hexdigest()
+            if not hmac.compare_digest(signature, str(request.httprequest.headers.get('X-Hub-Signature', ''))):
+                raise werkzeug.exceptions.Forbidden()
+        # queue the refs named in the payload so that only those get fetched,
+        # fallback on a full fetch at next cron otherwise
+        event = request.httprequest.headers.get('X-GitHub-Event')
+        try:
+            payload = simplejson.loads(post.get('payload') or request.httprequest.get_data())
+            queued = isinstance(payload, dict) and repo._queue_hook(event, payload)
+        except (ValueError, KeyError, TypeError):
+            queued = False
+        if not queued:
+            repo.hook_time = datetime.datetime.now().strftime(openerp.tools.DEFAULT_SERVER_DATETIME_FORMAT)
         return ""
 
     @http.route(['/runbot/dashboard'], type='http', auth="public", website=True)
@@ -1508,11 +3185,11 @@ class RunbotController(http.Controller):
 
         builds = RB.browse(map(operator.itemgetter(0), cr.fetchall()))
 
-        count = RB.search_count
+        stats = RB._stats_info(repos.ids)
         qctx = {
             'refresh': refresh,
-            'host_stats': [],
-            'pending_total': count([('state', '=', 'pending')]),
+            'host_stats': stats['host_stats'],
+            'pending_total': stats['pending_total'],
         }
 
         repos_values = qctx['repo_dict'] = OrderedDict()
@@ -1521,28 +3198,64 @@ class RunbotController(http.Controller):
             branch = build.branch_id
             r = repos_values.setdefault(repo.id, {'branches': OrderedDict()})
             if 'name' not in r:
+                r.update(stats['repos'][repo.id])
                 r.update({
                     'name': repo.name,
                     'base': repo.base,
-                    'testing': count([('repo_id', '=', repo.id), ('state', '=', 'testing')]),
-                    'running': count([('repo_id', '=', repo.id), ('state', '=', 'running')]),
-                    'pending': count([('repo_id', '=', repo.id), ('state', '=', 'pending')]),
                 })
             b = r['branches'].setdefault(branch.id, {'name': branch.branch_name, 'builds': list()})
             b['builds'].append(self.build_info(build))
 
-        # consider host gone if no build in last 100
-        build_threshold = max(builds.ids or [0]) - 100
-        for result in RB.read_group([('id', '>', build_threshold)], ['host'], ['host']):
-            if result['host']:
-                qctx['host_stats'].append({
-                    'host': result['host'],
-                    'testing': count([('state', '=', 'testing'), ('host', '=', result['host'])]),
-                    'running': count([('state', '=', 'running'), ('host', '=', result['host'])]),
-                })
-
         return request.render("runbot.sticky-dashboard", qctx)
 
+    @http.route(['/runbot/api/builds'], type='http', auth="public")
+    def api_builds(self, since=None, repo=None, limit='200', wait='0'):
+        """Builds written after the cursor since, waiting up to wait seconds
+        (at most runbot.feed_max_wait) for one to be written when there are
+        none yet"""
+        registry, cr, uid = request.registry, request.cr, request.uid
+        max_wait = int(registry['ir.config_parameter'].get_param(cr, uid, 'runbot.feed_max_wait', default=0))
+        try:
+            domain = [('id', '=', int(repo))] if repo else []
+            limit = max(1, min(int(limit), 1000))
+            deadline = time.time() + min(float(wait), max_wait, 10)
+            if since:
+                since_txid, since_id = since.split(',')
+                since = (int(since_txid), int(since_id))
+        except ValueError:
+            raise werkzeug.exceptions.BadRequest('Invalid parameters')
+        repo_ids = registry['runbot.repo'].search(cr, uid, domain)
+
+        Build = registry['runbot.build']
+        builds, cursor = Build._feed(cr, uid, repo_ids, since, limit)
+        while not builds and time.time() < deadline:
+            # end the transaction while waiting, the next query then sees
+            # the builds committed since
+            cr.commit()
+            time.sleep(1)
+            builds, cursor = Build._feed(cr, uid, repo_ids, since, limit)
+
+        result = {
+            'since': cursor and '%s,%s' % cursor,
+            'builds': builds,
+        }
+        return request.make_response(simplejson.dumps(result, default=str),
+                                     headers=[('Content-Type', 'application/json')])
+
+    @http.route(['/runbot/api/stats'], type='http', auth="public")
+    def api_stats(self):
+        registry, cr, uid = request.registry, request.cr, request.uid
+        repo_obj = registry['runbot.repo']
+        repo_ids = repo_obj.search(cr, uid, [])
+        stats = registry['runbot.build']._stats_info(cr, uid, repo_ids)
+        result = {
+            'pending': stats['pending_total'],
+            'repos': [dict(stats['repos'][repo.id], id=repo.id, name=repo.name)
+                      for repo in repo_obj.browse(cr, uid, repo_ids)],
+            'hosts': stats['host_stats'],
+        }
+        return request.make_response(simplejson.dumps(result), headers=[('Content-Type', 'application/json')])
+
     def build_info(self, build):
         real_build = build.duplicate_id if build.state == 'duplicate' else build
         return {
@@ -1592,18 +3305,34 @@ class RunbotController(http.Controller):
         if search:
             domain.append(('message', 'ilike', search))
         logging_ids = Logging.search(cr, SUPERUSER_ID, domain)
+        Usage = registry['runbot.build.usage']
+        usage_ids = Usage.search(cr, SUPERUSER_ID, [('build_id', '=', real_build.id), ('done', '=', True)], order='id')
 
         context = {
             'repo': build.repo_id,
             'build': self.build_info(build),
             'br': {'branch': build.branch_id},
             'logs': Logging.browse(cr, SUPERUSER_ID, logging_ids),
+            'usages': Usage.browse(cr, SUPERUSER_ID, usage_ids),
             'other_builds': other_builds
         }
         #context['type'] = type
         #context['level'] = level
         return request.render("runbot.build", context)
 
+    @http.route(['/runbot/branch/<int:branch_id>/timings'], type='http', auth="public", website=True)
+    def branch_timings(self, branch_id, **post):
+        registry, cr, uid = request.registry, request.cr, request.uid
+        branch = registry['runbot.branch'].browse(cr, uid, branch_id)
+        if not branch.exists():
+            return request.not_found()
+        context = {
+            'repo': branch.repo_id,
+            'branch': branch,
+            'trend': registry['runbot.build.timing']._trend(cr, SUPERUSER_ID, branch.id),
+        }
+        return request.render("runbot.branch_timings", context)
+
     @http.route(['/runbot/build/<int:build_id>/force'], type='http', auth="public", methods=['POST'], csrf=False)
     def build_force(self, build_id, search=None, **post):
         registry, cr, uid = request.registry, request.cr, request.uid
@@ -1666,29 +3395,38 @@ class RunbotController(http.Controller):
             'warning': "#fe7d37",
         }[state]
 
-        def text_width(s):
-            fp = FontProperties(family='DejaVu Sans', size=11)
-            w, h, d = TextToPath().get_text_width_height_descent(s, fp, False)
-            return int(w + 1)
-
         class Text(object):
             __slot__ = ['text', 'color', 'width']
             def __init__(self, text, color):
                 self.text = text
                 self.color = color
-                self.width = text_width(text) + 10
+                self.width = int(text_width(text) + 1) + 10
+
+        # the badge only depends on the key, a build change changes the state
+        key = (theme, branch, state)
+        with _badge_cache_lock:
+            svg = _badge_cache.pop(key, None)
+            if svg is not None:
+                _badge_cache[key] = svg
+        if svg is None:
+            data = {
+                'left': Text(branch, '#555'),
+                'right': Text(state, color),
+            }
+            svg = request.registry['ir.ui.view'].render(
+                request.cr, SUPERUSER_ID, "runbot.badge_" + theme, data, context=request.context)
+            with _badge_cache_lock:
+                _badge_cache[key] = svg
+                while len(_badge_cache) > _badge_cache_size:
+                    _badge_cache.popitem(last=False)
 
-        data = {
-            'left': Text(branch, '#555'),
-            'right': Text(state, color),
-        }
         five_minutes = 5 * 60
         headers = [
             ('Content-Type', 'image/svg+xml'),
             ('Cache-Control', 'max-age=%d' % (five_minutes * cache_factor,)),
             ('ETag', retag),
         ]
-        return request.render("runbot.badge_" + theme, data, headers=headers)
+        return request.make_response(svg, headers=headers)
 
     @http.route(['/runbot/b/<branch_name>', '/runbot/<model("runbot.repo"):repo>/<branch_name>'], type='http', auth="public", website=True)
     def fast_launch(self, branch_name=False, repo=False, **post):
@@ -1733,7 +3471,6 @@ class RunbotController(http.Controller):
 # - v6 support
 # - host field in build
 # - unlink build to remove ir_logging entires # ondelete=cascade
-# - gc either build or only old ir_logging
 # - if nginx server logfiles via each virtual server or map /runbot/static to root
 
 # vim: